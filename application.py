@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Application:
+    def __init__(self, clients, db, writer, media_cache, templates, shards, job_manager, sweeper,
+                 queues, handlers, metrics_server=None, sweep_client=None,
+                 sweep_on_startup: bool = True, resume_jobs: bool = True,
+                 shutdown_timeout: float = 25.0):
+        """
+        Every component of a running bot, with its startup and shutdown order
+
+        Building an Application does no I/O; startup() connects everything
+        and shutdown() drains it. Handlers reach the components through
+        client.application.
+
+        :param clients: Bot clients, in shard order
+        :param db: Database
+        :param writer: WriteBehindBuffer in front of the database
+        :param media_cache: MediaCache for welcome videos
+        :param templates: TemplateStore with the welcome messages
+        :param shards: ShardSet over the clients
+        :param job_manager: BroadcastJobManager
+        :param sweeper: JoinRequestSweeper
+        :param queues: Work queues behind the handlers, drained in order on
+            shutdown
+        :param handlers: Functions decorated with the Client.on_* decorators
+        :param metrics_server: MetricsServer, or None to serve no metrics
+        :param sweep_client: Admin user session used for sweeps, if any
+        :param sweep_on_startup: Sweep pending join requests after startup
+        :param resume_jobs: Pick up this deployment's running broadcast jobs
+            and reconcile the schema on startup; off for worker processes,
+            which only send chunks
+        :param shutdown_timeout: Seconds shutdown() may take in total
+        """
+        self.clients = list(clients)
+        self.db = db
+        self.writer = writer
+        self.media_cache = media_cache
+        self.templates = templates
+        self.shards = shards
+        self.job_manager = job_manager
+        self.sweeper = sweeper
+        self.queues = list(queues)
+        self.handlers = list(handlers)
+        self.metrics_server = metrics_server
+        self.sweep_client = sweep_client
+        self.sweep_on_startup = sweep_on_startup
+        self.resume_jobs = resume_jobs
+        self.shutdown_timeout = shutdown_timeout
+
+        self._stop = asyncio.Event()
+        self._sweep_task = None
+        for client in self.clients:
+            client.application = self
+
+    def queue(self, name: str):
+        for queue in self.queues:
+            if queue.name == name:
+                return queue
+        raise KeyError(name)
+
+    def _attach(self, client):
+        for func in self.handlers:
+            for handler, group in func.handlers:
+                client.add_handler(handler, group)
+
+    def _detach(self, client):
+        for func in self.handlers:
+            for handler, group in func.handlers:
+                client.remove_handler(handler, group)
+
+    async def _warm_database(self):
+        await self.db.connect()
+        # Indexes, retention and backfills belong to the bot process; a
+        # worker started with other settings must not undo them
+        if self.resume_jobs:
+            await self.db.ensure_schema()
+            await self.db.backfill_fields()
+
+    def start_workers(self):
+        """
+        Start the write-behind flusher and the queue workers; no I/O
+        """
+        self.writer.start()
+        for queue in self.queues:
+            queue.start()
+
+    async def startup(self):
+        """
+        Start the workers, then connect MongoDB, the metrics endpoint and
+        every client concurrently
+        """
+        self.start_workers()
+        for client in self.clients:
+            self._attach(client)
+
+        warm_up = [self._warm_database(), self.media_cache.load(), self.templates.load()]
+        warm_up += [client.start() for client in self.clients]
+        if self.sweep_client:
+            warm_up.append(self.sweep_client.start())
+        if self.metrics_server and self.metrics_server.port:
+            warm_up.append(self.metrics_server.start())
+        await asyncio.gather(*warm_up)
+        self.templates.start()
+
+        # Pick up broadcasts interrupted by the last shutdown or crash
+        if self.resume_jobs:
+            await self.job_manager.resume_all()
+        # Send chunks of chunked broadcasts, whichever process created them
+        self.job_manager.start_consuming()
+        # Clear join requests that arrived while the bot was down
+        if self.sweep_on_startup:
+            self._sweep_task = asyncio.create_task(self._startup_sweep())
+
+    async def _startup_sweep(self):
+        try:
+            cleared, failed = await self.sweeper.sweep(self.sweep_client or self.shards.primary.client)
+            total = sum(count for _, count in cleared.values())
+            logger.info(f"Startup sweep approved {total} requests in {len(cleared)} chats, {failed} skipped")
+        except Exception as e:
+            logger.error(f"Error in startup sweep: {e}")
+
+    def request_stop(self):
+        """
+        Make run() shut down, e.g. from a signal handler
+        """
+        self._stop.set()
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                # No loop signal support, e.g. on Windows
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(self.request_stop))
+
+    async def shutdown(self):
+        """
+        Stop taking updates, drain queued work and checkpoint broadcasts,
+        giving up on whatever is left once shutdown_timeout has passed
+        """
+        deadline = time.monotonic() + self.shutdown_timeout
+
+        async def bounded(name, awaitable):
+            try:
+                await asyncio.wait_for(awaitable, timeout=max(deadline - time.monotonic(), 0.1))
+            except asyncio.TimeoutError:
+                logger.warning(f"Shutdown deadline hit while {name}")
+            except Exception as e:
+                logger.error(f"Error while {name}: {e}")
+
+        # New join requests stay pending in Telegram; the startup sweep
+        # approves them after the restart
+        for client in self.clients:
+            self._detach(client)
+        if self._sweep_task:
+            self._sweep_task.cancel()
+        await self.templates.close()
+
+        async def drain_queues():
+            # In order, since earlier queues feed later ones. Each gets an
+            # even share of what is left, so approvals stuck behind a
+            # FloodWait cannot starve persistence and welcomes, and a fifth
+            # of the deadline is kept for flushing and stopping the clients
+            drained_by = deadline - max(self.shutdown_timeout / 5, 1)
+            for index, queue in enumerate(self.queues):
+                share = (drained_by - time.monotonic()) / (len(self.queues) - index)
+                await bounded(f"draining the {queue.name} queue", queue.close(timeout=max(share, 0)))
+
+        # Broadcasts checkpoint and stay marked running so the next start
+        # resumes them; queued DMs still need the clients connected
+        await asyncio.gather(
+            bounded("checkpointing broadcasts", self.job_manager.stop_all()),
+            drain_queues()
+        )
+        # Flush buffered upserts before the connection goes away
+        await bounded("flushing buffered writes", self.writer.close())
+
+        clients = self.clients + ([self.sweep_client] if self.sweep_client else [])
+        await asyncio.gather(*(bounded("stopping clients", client.stop()) for client in clients))
+        await bounded("closing MongoDB", self.db.close())
+        if self.metrics_server:
+            await self.metrics_server.close()
+
+    async def run(self):
+        """
+        Start the bot, serve until SIGINT/SIGTERM, then shut down gracefully
+        """
+        self._install_signal_handlers()
+        try:
+            await self.startup()
+            logger.info("Bot is running...")
+            await self._stop.wait()
+        finally:
+            await self.shutdown()
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from pyrogram.errors import FloodWait
+
+from metrics import APPROVAL_LAG_SECONDS, FLOOD_WAIT_SECONDS, FLOOD_WAITS, JOIN_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLane:
+    def __init__(self, chat_id: int, limit: float):
+        """
+        Pending approvals of one chat and the concurrency it is allowed
+        """
+        self.chat_id = chat_id
+        self.pending = deque()
+        self.in_flight = 0
+        self.limit = limit
+        self.paused_until = 0.0
+        self.last_active = time.monotonic()
+
+        # Metrics
+        self.approved = 0
+        self.flood_waits = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def ready(self, now: float):
+        return bool(self.pending) and self.in_flight < int(self.limit) and now >= self.paused_until
+
+
+class ApprovalScheduler:
+    def __init__(self, on_approved=None, workers: int = 16, initial_limit: float = 2.0,
+                 max_limit: float = 10.0, max_pending_per_chat: int = 10000,
+                 max_attempts: int = 5, idle_ttl: float = 600.0):
+        """
+        Approve join requests chat by chat with adaptive concurrency
+
+        Each chat has its own queue and a concurrency limit tuned by AIMD:
+        every approval adds 1/limit, so the limit grows by about one per
+        round of successes, and a FloodWait halves it and pauses the chat for
+        the requested time. Chats take turns round-robin for the shared
+        worker slots, so a surge in one channel only slows that channel.
+
+        Exposes the same name/submit/start/close/stats interface as
+        WorkQueue.
+
+        :param on_approved: Coroutine function called with (client,
+            join_request) after each successful approval
+        :param workers: Approvals in flight across all chats
+        :param initial_limit: Concurrency a chat starts with
+        :param max_limit: Highest concurrency a chat can reach
+        :param max_pending_per_chat: Requests queued per chat before new
+            ones are dropped; dropped requests stay pending in Telegram
+        :param max_attempts: Tries per request before giving up
+        :param idle_ttl: Seconds an idle chat's state is kept
+        """
+        self.name = "approve"
+        self.on_approved = on_approved
+        self.workers = workers
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.max_pending_per_chat = max_pending_per_chat
+        self.max_attempts = max_attempts
+        self.idle_ttl = idle_ttl
+
+        self._lanes = {}
+        # Chats with pending requests, in turn order
+        self._ring = deque()
+        self._slots = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._dispatcher = None
+        self._closing = False
+
+        # Metrics
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def depth(self):
+        return sum(len(lane.pending) for lane in self._lanes.values())
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_lag': round(self.last_lag, 3),
+            'max_lag': round(self.max_lag, 3),
+        }
+
+    def chat_stats(self, limit: int = 10):
+        """
+        Busiest chats first: pending, in flight, concurrency limit and lag
+
+        :param limit: Number of chats to report
+        """
+        lanes = sorted(self._lanes.values(), key=lambda lane: (-len(lane.pending), -lane.max_lag))
+        return [
+            {
+                'chat_id': lane.chat_id,
+                'pending': len(lane.pending),
+                'in_flight': lane.in_flight,
+                'limit': round(lane.limit, 2),
+                'approved': lane.approved,
+                'flood_waits': lane.flood_waits,
+                'last_lag': round(lane.last_lag, 3),
+                'max_lag': round(lane.max_lag, 3),
+            }
+            for lane in lanes[:limit]
+        ]
+
+    async def submit(self, item):
+        """
+        Queue a (client, join_request) pair for approval
+
+        :return: False if the request was dropped because its chat's queue
+            is full or the scheduler is closing
+        """
+        client, join_request = item
+        chat_id = join_request.chat.id
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = ChatLane(chat_id, self.initial_limit)
+        if self._closing or len(lane.pending) >= self.max_pending_per_chat:
+            self.dropped += 1
+            logger.warning(f"Approval queue for {chat_id} full, leaving request pending",
+                           extra={'event': 'approval_dropped', 'chat_id': chat_id})
+            return False
+
+        if not lane.pending:
+            self._ring.append(chat_id)
+        lane.pending.append((time.monotonic(), 1, item))
+        lane.last_active = time.monotonic()
+        self.submitted += 1
+        self._wakeup.set()
+        return True
+
+    def _next_ready(self, now: float):
+        # Round-robin: the chat that gets a slot moves to the back of the ring
+        for _ in range(len(self._ring)):
+            chat_id = self._ring[0]
+            self._ring.rotate(-1)
+            lane = self._lanes[chat_id]
+            if lane.ready(now):
+                return lane
+        return None
+
+    def _next_wakeup(self, now: float):
+        # Earliest end of a pause among chats waiting on one
+        paused = [self._lanes[chat_id].paused_until for chat_id in self._ring
+                  if self._lanes[chat_id].paused_until > now]
+        return min(paused) - now if paused else None
+
+    def _prune(self, now: float):
+        for chat_id, lane in list(self._lanes.items()):
+            if not lane.pending and not lane.in_flight and now - lane.last_active > self.idle_ttl:
+                del self._lanes[chat_id]
+
+    async def _dispatch(self):
+        last_prune = time.monotonic()
+        while True:
+            await self._slots.acquire()
+            while True:
+                now = time.monotonic()
+                lane = self._next_ready(now)
+                if lane is not None:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._next_wakeup(now))
+                except asyncio.TimeoutError:
+                    pass
+
+            enqueued, attempt, item = lane.pending.popleft()
+            if not lane.pending:
+                self._ring.remove(lane.chat_id)
+            lane.in_flight += 1
+            task = asyncio.create_task(self._approve(lane, enqueued, attempt, item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            if now - last_prune > self.idle_ttl:
+                self._prune(now)
+                last_prune = now
+
+    async def _approve(self, lane: ChatLane, enqueued: float, attempt: int, item):
+        client, join_request = item
+        lag = time.monotonic() - enqueued
+        lane.last_lag = self.last_lag = lag
+        lane.max_lag = max(lane.max_lag, lag)
+        self.max_lag = max(self.max_lag, lag)
+        APPROVAL_LAG_SECONDS.observe(lag)
+        try:
+            await client.approve_chat_join_request(
+                chat_id=join_request.chat.id,
+                user_id=join_request.from_user.id
+            )
+        except FloodWait as e:
+            # Multiplicative decrease, and no approvals in this chat until the wait is over
+            lane.limit = max(1.0, lane.limit / 2)
+            lane.paused_until = max(lane.paused_until, time.monotonic() + e.value)
+            lane.flood_waits += 1
+            FLOOD_WAITS.inc(source='approve')
+            FLOOD_WAIT_SECONDS.inc(e.value, source='approve')
+            if attempt < self.max_attempts:
+                if not lane.pending:
+                    self._ring.append(lane.chat_id)
+                lane.pending.appendleft((enqueued, attempt + 1, item))
+            else:
+                self.failed += 1
+                logger.warning(f"Giving up approving {join_request.from_user.id} in {lane.chat_id} after {attempt} flood waits",
+                               extra={'event': 'approval_failed', 'chat_id': lane.chat_id,
+                                      'user_id': join_request.from_user.id})
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error approving join request in {lane.chat_id}: {e}",
+                         extra={'event': 'approval_error', 'chat_id': lane.chat_id,
+                                'user_id': join_request.from_user.id})
+        else:
+            # Additive increase: about +1 per round of successful approvals
+            lane.limit = min(self.max_limit, lane.limit + 1 / lane.limit)
+            lane.approved += 1
+            self.processed += 1
+            latency = time.monotonic() - enqueued
+            JOIN_REQUEST_SECONDS.observe(latency)
+            # One per join, so sampled by default (see LOG_SAMPLE)
+            logger.info("Approved join request", extra={
+                'event': 'join_approved',
+                'chat_id': lane.chat_id,
+                'user_id': join_request.from_user.id,
+                'latency': round(latency, 4),
+                'lag': round(lag, 4),
+            })
+            if self.on_approved:
+                try:
+                    await self.on_approved(client, join_request)
+                except Exception as e:
+                    logger.error(f"Error after approving join request in {lane.chat_id}: {e}")
+        finally:
+            lane.in_flight -= 1
+            lane.last_active = time.monotonic()
+            self._slots.release()
+            self._wakeup.set()
+
+    def start(self):
+        """
+        Start dispatching approvals
+        """
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self, timeout: float = None):
+        """
+        Stop taking requests and wait for the queued ones to be approved
+
+        :param timeout: Longest time to wait; requests still queued then
+            stay pending in Telegram
+        """
+        self._closing = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.depth or self._tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning(f"{self.name} queue closed with {self.depth} requests left")
+                break
+            await asyncio.sleep(0.05)
+        tasks = list(self._tasks)
+        if self._dispatcher is not None:
+            tasks.append(self._dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
@@ -0,0 +1,103 @@
+"""
+Replay simulated join requests through handle_join_request against a local
+mongod and report approval latency.
+
+Telegram calls are replaced by a fake client that sleeps for a configurable
+round trip. Latency runs from the handler call until the request is
+approved; persistence and the welcome DM run on the bot's work queues,
+whose lag is reported too.
+
+Usage (from the repository root):
+
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.bench_join_requests -n 5000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import bot
+from benchmarks.fakes import FakeClient, make_join_request
+from database import Database
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run(args):
+    db = Database(args.mongo_uri, db_name=args.db_name)
+    await db.connect()
+    client = FakeClient(args.api_latency / 1000)
+    application = bot.create_app(
+        {"BROADCAST_RATE": args.send_rate, "METRICS_PORT": 0},
+        clients=[client],
+        db=db
+    )
+    application.start_workers()
+
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(make_join_request(1_000_000 + i, -100_000 - i % args.chats))
+
+    latencies = []
+    # id(join_request) -> handler call; the scheduler holds the request until then
+    arrivals = {}
+    approvals = application.queue("approve")
+    on_approved = approvals.on_approved
+
+    async def timed_on_approved(client, join_request):
+        latencies.append((time.perf_counter() - arrivals.pop(id(join_request))) * 1000)
+        await on_approved(client, join_request)
+
+    approvals.on_approved = timed_on_approved
+
+    # Pyrogram dispatches updates to a fixed number of handler workers
+    async def worker():
+        while not queue.empty():
+            join_request = queue.get_nowait()
+            arrivals[id(join_request)] = time.perf_counter()
+            await bot.handle_join_request(client, join_request)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.workers)))
+    # Approvals finish on the scheduler's workers, after the handlers return
+    await approvals.close()
+    elapsed = time.perf_counter() - started
+
+    # Let the background work finish so its cost shows up in the DB stats
+    for queue in application.queues:
+        await queue.close()
+    await application.writer.close()
+    write_stats = application.writer.stats()
+    await db.client.drop_database(args.db_name)
+    await db.close()
+
+    print(f"requests:   {len(latencies)}")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s")
+    print(f"p50:        {statistics.median(latencies):.2f} ms")
+    print(f"p99:        {percentile(latencies, 99):.2f} ms")
+    for queue in application.queues:
+        stats = queue.stats()
+        print(f"{queue.name + ' queue:':<12}max lag {stats['max_lag'] * 1000:.1f} ms, dropped {stats['dropped']}")
+    print(f"db writes:  {write_stats['written']} docs for {write_stats['submitted']} upserts "
+          f"(coalescing ratio {write_stats['coalescing_ratio']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark join request approval latency")
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=10, help="distinct chats the requests target")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent handler workers")
+    parser.add_argument("--api-latency", type=float, default=50.0, help="simulated Telegram RTT in ms")
+    parser.add_argument("--send-rate", type=float, default=1000.0, help="welcome DM send budget in msgs/s")
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="ApproveBotBench")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
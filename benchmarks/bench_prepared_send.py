@@ -0,0 +1,74 @@
+"""
+Measure the per-recipient cost of PreparedSend in isolation.
+
+A fake client records calls without any network latency, so the numbers
+are pure Python overhead per send and the API calls each send makes.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_prepared_send -n 100000
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+from pyrogram.enums import MessageMediaType
+
+from sending import PreparedSend
+
+
+class FakeClient:
+    """Counts API calls instead of making them"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_cached_media(self, chat_id, file_id, caption="", caption_entities=None, reply_markup=None):
+        self.calls += 1
+
+    async def send_message(self, chat_id, text, entities=None, reply_markup=None):
+        self.calls += 1
+
+
+def make_message(media_type):
+    """Minimal stand-in for a pyrogram Message of the given media type"""
+    message = SimpleNamespace(
+        media=media_type,
+        text=None if media_type else "Hello **everyone**",
+        entities=None,
+        caption="Caption" if media_type else None,
+        caption_entities=None,
+        reply_markup=None
+    )
+    if media_type:
+        setattr(message, media_type.value, SimpleNamespace(file_id=f"{media_type.value}-file-id"))
+    return message
+
+
+async def run(args):
+    kinds = [None, MessageMediaType.PHOTO, MessageMediaType.VIDEO, MessageMediaType.DOCUMENT,
+             MessageMediaType.STICKER, MessageMediaType.VIDEO_NOTE]
+    print(f"{'kind':<12}{'sends/s':>14}{'us/send':>10}{'calls/send':>12}")
+    for media_type in kinds:
+        client = FakeClient()
+        send = PreparedSend(client, make_message(media_type))
+
+        started = time.perf_counter()
+        for chat_id in range(args.sends):
+            await send(chat_id)
+        elapsed = time.perf_counter() - started
+
+        name = media_type.value if media_type else "text"
+        print(f"{name:<12}{args.sends / elapsed:>14,.0f}{elapsed / args.sends * 1e6:>10.2f}"
+              f"{client.calls / args.sends:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PreparedSend overhead")
+    parser.add_argument("-n", "--sends", type=int, default=100000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
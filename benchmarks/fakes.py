@@ -0,0 +1,196 @@
+"""
+Offline stand-ins for Telegram and MongoDB used by the load tests.
+
+FakeClient answers the pyrogram calls the bot makes after a simulated round
+trip, and can inject FloodWait errors and blocked users. MemoryDatabase
+implements the part of Database the join path and broadcasts use, keeping
+documents in dicts so a load test runs without a mongod.
+"""
+import asyncio
+import random
+from types import SimpleNamespace
+
+from pyrogram.enums import ChatType
+from pyrogram.errors import FloodWait, UserIsBlocked
+
+
+class FakeClient:
+    """Stands in for pyrogram.Client with simulated latency and failures"""
+
+    def __init__(self, api_latency: float = 0.05, jitter: float = 0.0, flood_wait_rate: float = 0.0,
+                 flood_wait_seconds: int = 1, blocked=(), bot_id: int = 1, seed: int = None):
+        """
+        :param api_latency: Mean simulated round trip in seconds
+        :param jitter: Round trips vary uniformly by this fraction of the mean
+        :param flood_wait_rate: Share of sends answered with a FloodWait
+        :param flood_wait_seconds: Wait demanded by each FloodWait
+        :param blocked: User IDs that have blocked the bot
+        :param bot_id: ID reported as client.me.id
+        :param seed: Seed for the failure and latency draws
+        """
+        self.api_latency = api_latency
+        self.jitter = jitter
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        self.blocked = set(blocked)
+        self.me = SimpleNamespace(id=bot_id, username=f"bot{bot_id}")
+        self.random = random.Random(seed)
+
+        self.calls = 0
+        self.sends = 0
+        self.flood_waits = 0
+
+    async def _round_trip(self):
+        self.calls += 1
+        latency = self.api_latency
+        if self.jitter:
+            latency *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(latency)
+
+    async def _send(self, chat_id, **fields):
+        await self._round_trip()
+        if self.flood_wait_rate and self.random.random() < self.flood_wait_rate:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_wait_seconds)
+        if chat_id in self.blocked:
+            raise UserIsBlocked()
+        self.sends += 1
+        return SimpleNamespace(id=self.sends, chat=SimpleNamespace(id=chat_id), **fields)
+
+    async def approve_chat_join_request(self, chat_id, user_id):
+        await self._round_trip()
+        if self.flood_wait_rate and self.random.random() < self.flood_wait_rate:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_wait_seconds)
+        return True
+
+    async def send_video(self, chat_id, video, caption=None, reply_markup=None, **kwargs):
+        return await self._send(chat_id, video=SimpleNamespace(file_id=f"cached-{str(video)[-8:]}"))
+
+    async def send_cached_media(self, chat_id, file_id, caption="", caption_entities=None, reply_markup=None):
+        return await self._send(chat_id)
+
+    async def send_message(self, chat_id, text, entities=None, reply_markup=None, **kwargs):
+        return await self._send(chat_id, text=text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self._round_trip()
+
+
+def make_message(text: str = "Hello **everyone**"):
+    """Minimal stand-in for a pyrogram text Message, as PreparedSend reads it"""
+    return SimpleNamespace(media=None, text=text, entities=None, caption=None,
+                           caption_entities=None, reply_markup=None)
+
+
+def make_join_request(user_id: int, chat_id: int, chat_type=None):
+    """Minimal stand-in for a pyrogram ChatJoinRequest"""
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="User"),
+        chat=SimpleNamespace(id=chat_id, title=f"Chat {chat_id}", type=chat_type or ChatType.CHANNEL),
+    )
+
+
+class MemoryCollection:
+    """Documents of one collection, keyed on a single field"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = {}
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False):
+        # Only used for small keyed collections such as media_cache
+        key = tuple(sorted(filter.items()))
+        document = self.documents.get(key)
+        if document is None and upsert:
+            document = self.documents[key] = dict(filter)
+            apply_update(document, update, inserted=True)
+        elif document is not None:
+            apply_update(document, update, inserted=False)
+
+
+def apply_update(document: dict, update: dict, inserted: bool):
+    """
+    Apply the update operators the bot uses to a document in place
+    """
+    document.update(update.get('$set', {}))
+    for field in update.get('$unset', {}):
+        document.pop(field, None)
+    if inserted:
+        document.update(update.get('$setOnInsert', {}))
+    for field, value in update.get('$inc', {}).items():
+        document[field] = document.get(field, 0) + value
+    for field, value in update.get('$addToSet', {}).items():
+        values = document.setdefault(field, [])
+        for item in value['$each']:
+            if item not in values:
+                values.append(item)
+
+
+class MemoryDatabase:
+    def __init__(self, op_latency: float = 0.0):
+        """
+        In-memory stand-in for Database, enough for the join path and
+        recipient iteration
+
+        :param op_latency: Simulated round trip of each database call
+        """
+        self.op_latency = op_latency
+        self.users_collection = MemoryCollection('users')
+        self.channels_collection = MemoryCollection('channels')
+        self.groups_collection = MemoryCollection('groups')
+        self.memberships_collection = MemoryCollection('memberships')
+        self.daily_stats_collection = MemoryCollection('daily_stats')
+        self.chat_stats_collection = MemoryCollection('chat_stats')
+        self.media_cache_collection = MemoryCollection('media_cache')
+        self.round_trips = 0
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        if self.op_latency:
+            await asyncio.sleep(self.op_latency)
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def bulk_upsert(self, collection: MemoryCollection, key_field, updates: dict, upsert: bool = True):
+        await self._round_trip()
+        upserted = 0
+        for key, update in updates.items():
+            document = collection.documents.get(key)
+            if document is None:
+                if not upsert:
+                    continue
+                upserted += 1
+                fields = dict(zip(key_field, key)) if isinstance(key_field, tuple) else {key_field: key}
+                document = collection.documents[key] = fields
+                apply_update(document, update, inserted=True)
+            else:
+                apply_update(document, update, inserted=False)
+        return SimpleNamespace(upserted_count=upserted)
+
+    async def _iter_ids(self, collection: MemoryCollection, key_field: str, batch_size: int, with_bots: bool):
+        documents = [doc for doc in collection.documents.values() if not doc.get('blocked')]
+        documents.sort(key=lambda doc: doc.get('rand', 0))
+        for start in range(0, len(documents), batch_size):
+            await self._round_trip()
+            for document in documents[start:start + batch_size]:
+                if with_bots:
+                    yield document[key_field], document.get('bots') or ()
+                else:
+                    yield document[key_field]
+
+    def iter_user_ids(self, batch_size: int = 1000, with_bots: bool = False):
+        return self._iter_ids(self.users_collection, 'user_id', batch_size, with_bots)
+
+    def iter_group_ids(self, batch_size: int = 1000, with_bots: bool = False):
+        return self._iter_ids(self.groups_collection, 'chat_id', batch_size, with_bots)
+
+    async def count_users(self):
+        return sum(1 for doc in self.users_collection.documents.values() if not doc.get('blocked'))
+
+    async def count_groups(self):
+        return sum(1 for doc in self.groups_collection.documents.values() if not doc.get('blocked'))
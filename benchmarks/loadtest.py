@@ -0,0 +1,261 @@
+"""
+Offline load test: replay join-request and broadcast traces through the
+bot's real handlers and engine, with Telegram replaced by FakeClient.
+
+Importing bot has no side effects and bot.create_app() only builds the
+components, so the handlers are driven directly with fake clients
+injected. The database is either an in-memory stand-in or a throwaway
+database on a local mongod.
+
+Usage (from the repository root):
+
+    python -m benchmarks.loadtest --flood-wait-rate 0.01 join -n 5000 --rate 500
+    python -m benchmarks.loadtest --bots 2 broadcast --users 20000 --blocked-ratio 0.05
+    python -m benchmarks.loadtest --backend mongo --mongo-uri mongodb://localhost:27017 join
+
+Options shared by both modes go before the mode. Add --save-trace FILE
+to keep the generated workload and --trace FILE to replay it later
+against another version of the code.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import bot
+from benchmarks import traces
+from benchmarks.fakes import FakeClient, MemoryDatabase, make_join_request, make_message
+from broadcast import PRIVATE_CHAT_INTERVAL, BroadcastEngine, RetryPolicy, TokenBucket
+from database import Database, user_update
+from sending import PreparedSend
+from shards import Shard, ShardSet
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report_latency(name: str, samples):
+    if not samples:
+        print(f"{name}: no samples")
+        return
+    print(f"{name} (ms): p50 {statistics.median(samples) * 1000:.2f}, "
+          f"p95 {percentile(samples, 95) * 1000:.2f}, p99 {percentile(samples, 99) * 1000:.2f}, "
+          f"max {max(samples) * 1000:.2f}")
+
+
+async def open_database(args):
+    if args.backend == 'memory':
+        return MemoryDatabase(op_latency=args.db_latency / 1000)
+    db = Database(args.mongo_uri, db_name=args.db_name)
+    await db.connect()
+    await db.ensure_indexes()
+    return db
+
+
+async def close_database(db, args):
+    if isinstance(db, Database):
+        await db.client.drop_database(args.db_name)
+    await db.close()
+
+
+def make_clients(args, blocked=()):
+    return [
+        FakeClient(
+            api_latency=args.api_latency / 1000,
+            jitter=args.jitter,
+            flood_wait_rate=args.flood_wait_rate,
+            flood_wait_seconds=args.flood_wait_seconds,
+            blocked=blocked,
+            bot_id=index + 1,
+            seed=None if args.seed is None else args.seed + index
+        )
+        for index in range(args.bots)
+    ]
+
+
+async def run_join(args):
+    trace = traces.load(args.trace) if args.trace else traces.join_trace(
+        args.requests, args.rate, chats=args.chats, bots=args.bots, seed=args.seed
+    )
+    if args.save_trace:
+        traces.save(trace, args.save_trace)
+
+    bots = max(event['bot'] for event in trace) + 1
+    args.bots = max(args.bots, bots)
+    clients = make_clients(args)
+    db = await open_database(args)
+
+    application = bot.create_app(
+        {"BROADCAST_RATE": args.send_rate, "METRICS_PORT": 0},
+        clients=clients,
+        db=db
+    )
+    application.start_workers()
+
+    # Pyrogram hands updates to a fixed pool of handler workers
+    dispatch = asyncio.Queue()
+    latencies = []
+    approval_latencies = []
+    # id(join_request) -> arrival; the scheduler holds the request until then
+    arrivals = {}
+    approvals = application.queue("approve")
+    on_approved = approvals.on_approved
+    last_approved = None
+
+    async def timed_on_approved(client, join_request):
+        nonlocal last_approved
+        last_approved = time.perf_counter()
+        approval_latencies.append(last_approved - arrivals.pop(id(join_request)))
+        await on_approved(client, join_request)
+
+    approvals.on_approved = timed_on_approved
+
+    async def feed(started):
+        for event in trace:
+            due = started + event['t'] / args.speed if args.speed else started
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            dispatch.put_nowait((due, event))
+        for _ in range(args.workers):
+            dispatch.put_nowait(None)
+
+    async def worker():
+        while True:
+            item = await dispatch.get()
+            if item is None:
+                return
+            arrived, event = item
+            join_request = make_join_request(event['user_id'], event['chat_id'])
+            arrivals[id(join_request)] = arrived
+            await bot.handle_join_request(clients[event['bot']], join_request)
+            # From the request's arrival, so handler queueing counts too
+            latencies.append(time.perf_counter() - arrived)
+
+    started = time.perf_counter()
+    await asyncio.gather(feed(started), *(worker() for _ in range(args.workers)))
+    elapsed = time.perf_counter() - started
+
+    # Drained in order, so each queue's time is what it added after the last
+    drain_seconds = {}
+    for queue in application.queues:
+        drain_started = time.perf_counter()
+        await queue.close()
+        drain_seconds[queue.name] = time.perf_counter() - drain_started
+    approved_by = (last_approved or started) - started
+    await application.writer.close()
+    write_stats = application.writer.stats()
+    await close_database(db, args)
+
+    print(f"join requests: {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s)")
+    print(f"approved: {len(approval_latencies)} in {approved_by:.2f}s "
+          f"({len(approval_latencies) / max(approved_by, 1e-9):.1f} req/s)")
+    # The handler only hands the request to the approval scheduler
+    report_latency("handler latency", latencies)
+    report_latency("approval latency", approval_latencies)
+    for queue in application.queues:
+        stats = queue.stats()
+        print(f"{queue.name} queue: processed {stats['processed']}, failed {stats['failed']}, "
+              f"dropped {stats['dropped']}, max lag {stats['max_lag'] * 1000:.1f} ms, "
+              f"drained in {drain_seconds[queue.name]:.2f}s after the handlers")
+    print(f"telegram: {sum(c.calls for c in clients)} calls, {sum(c.flood_waits for c in clients)} flood waits")
+    print(f"db writes: {write_stats['written']} docs for {write_stats['submitted']} upserts "
+          f"(coalescing ratio {write_stats['coalescing_ratio']})")
+
+
+async def run_broadcast(args):
+    audience = traces.load(args.trace) if args.trace else traces.broadcast_trace(
+        args.users, bots=args.bots, blocked_ratio=args.blocked_ratio, seed=args.seed
+    )
+    if args.save_trace:
+        traces.save(audience, args.save_trace)
+
+    args.bots = max(args.bots, max(entry['bot'] for entry in audience) + 1)
+    blocked = {entry['user_id'] for entry in audience if entry['blocked']}
+    clients = make_clients(args, blocked)
+    db = await open_database(args)
+
+    # Seed the audience the way the join path records users
+    for start in range(0, len(audience), 1000):
+        await db.bulk_upsert(db.users_collection, 'user_id', {
+            entry['user_id']: user_update(f"user{entry['user_id']}", clients[entry['bot']].me.id)
+            for entry in audience[start:start + 1000]
+        })
+
+    engine = BroadcastEngine(
+        [TokenBucket(args.send_rate) for _ in clients],
+        workers=args.broadcast_workers,
+        retry_policy=RetryPolicy(max_attempts=args.max_attempts)
+    )
+    shards = ShardSet([Shard(index, client, engine.buckets[index]) for index, client in enumerate(clients)])
+    latencies = []
+
+    def timed(send):
+        async def timed_send(chat_id):
+            started = time.perf_counter()
+            try:
+                return await send(chat_id)
+            finally:
+                latencies.append(time.perf_counter() - started)
+        return timed_send
+
+    source = make_message()
+    senders = [timed(PreparedSend(shard.client, source)) for shard in shards]
+
+    stats = await engine.run(
+        db.iter_user_ids(with_bots=True),
+        senders,
+        chat_interval=PRIVATE_CHAT_INTERVAL,
+        total=await db.count_users(),
+        route=shards.route
+    )
+    await close_database(db, args)
+
+    print(f"recipients: {stats.processed} in {stats.elapsed:.2f}s ({stats.rate:.1f} msgs/s)")
+    print(f"delivered {stats.delivered}, unreachable {stats.unreachable}, failed {stats.failed}, "
+          f"dropped {stats.dropped}, retried {stats.retried}, flood waits {stats.flood_waits}")
+    report_latency("send latency", latencies)
+    for shard in shards:
+        print(f"bot {shard.bot_id}: {shard.client.sends} sends")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic traces against the bot offline")
+    parser.add_argument("--backend", choices=("memory", "mongo"), default="memory")
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default="ApproveBotLoadTest")
+    parser.add_argument("--db-latency", type=float, default=1.0, help="memory backend round trip in ms")
+    parser.add_argument("--api-latency", type=float, default=50.0, help="simulated Telegram RTT in ms")
+    parser.add_argument("--jitter", type=float, default=0.3, help="RTT variation as a fraction of the mean")
+    parser.add_argument("--flood-wait-rate", type=float, default=0.0, help="share of sends hit by FloodWait")
+    parser.add_argument("--flood-wait-seconds", type=int, default=1)
+    parser.add_argument("--bots", type=int, default=1, help="bot tokens to simulate")
+    parser.add_argument("--send-rate", type=float, default=25.0, help="send budget per bot in msgs/s")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", help="replay a saved trace instead of generating one")
+    parser.add_argument("--save-trace", help="save the generated trace as JSON lines")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    join = modes.add_parser("join", help="replay join requests through handle_join_request")
+    join.add_argument("-n", "--requests", type=int, default=2000)
+    join.add_argument("--rate", type=float, default=200.0, help="mean arrivals per second, 0 for all at once")
+    join.add_argument("--speed", type=float, default=1.0, help="replay speed-up, 0 ignores arrival times")
+    join.add_argument("--chats", type=int, default=10)
+    join.add_argument("--workers", type=int, default=8, help="concurrent handler workers")
+
+    broadcast = modes.add_parser("broadcast", help="replay a broadcast through BroadcastEngine")
+    broadcast.add_argument("--users", type=int, default=5000)
+    broadcast.add_argument("--blocked-ratio", type=float, default=0.05)
+    broadcast.add_argument("--broadcast-workers", type=int, default=20)
+    broadcast.add_argument("--max-attempts", type=int, default=5)
+
+    args = parser.parse_args()
+    asyncio.run(run_join(args) if args.mode == "join" else run_broadcast(args))
+
+
+if __name__ == "__main__":
+    main()
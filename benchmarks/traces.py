@@ -0,0 +1,74 @@
+"""
+Synthetic, replayable workloads for the load tests.
+
+A join trace is a list of join requests with arrival offsets; a broadcast
+trace is the audience a broadcast goes to. Both are generated from a seed
+and can be saved as JSON lines, so the same workload can be replayed
+against two versions of the bot.
+"""
+import json
+import random
+
+
+def join_trace(requests: int, rate: float, chats: int = 10, bots: int = 1,
+               repeat_ratio: float = 0.1, seed: int = None):
+    """
+    Join requests arriving as a Poisson process
+
+    Chat popularity is skewed (Zipf-like), since a few large channels get
+    most of the requests, and a share of requests come from users who
+    already joined another chat.
+
+    :param requests: Number of join requests
+    :param rate: Mean arrivals per second; 0 sends them all at once
+    :param chats: Distinct chats the requests target
+    :param bots: Bots the chats are spread over
+    :param repeat_ratio: Share of requests from users seen before
+    :param seed: Seed for the draws
+    :return: List of {'t', 'user_id', 'chat_id', 'bot'} events
+    """
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(chats)]
+    chat_ids = [-1_000_000_000_000 - index for index in range(chats)]
+    events = []
+    users = []
+    now = 0.0
+    for _ in range(requests):
+        if rate:
+            now += rng.expovariate(rate)
+        if users and rng.random() < repeat_ratio:
+            user_id = rng.choice(users)
+        else:
+            user_id = 1_000_000 + len(users)
+            users.append(user_id)
+        index = rng.choices(range(chats), weights)[0]
+        events.append({'t': round(now, 6), 'user_id': user_id, 'chat_id': chat_ids[index], 'bot': index % bots})
+    return events
+
+
+def broadcast_trace(users: int, bots: int = 1, blocked_ratio: float = 0.05, seed: int = None):
+    """
+    Audience of a broadcast
+
+    :param users: Number of recipients
+    :param bots: Bots the users are spread over
+    :param blocked_ratio: Share of users who blocked the bot
+    :param seed: Seed for the draws
+    :return: List of {'user_id', 'bot', 'blocked'} entries
+    """
+    rng = random.Random(seed)
+    return [
+        {'user_id': 1_000_000 + index, 'bot': rng.randrange(bots), 'blocked': rng.random() < blocked_ratio}
+        for index in range(users)
+    ]
+
+
+def save(trace, path: str):
+    with open(path, 'w') as file:
+        for event in trace:
+            file.write(json.dumps(event) + '\n')
+
+
+def load(path: str):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
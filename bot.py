@@ -1,7 +1,5 @@
 from pyrogram import Client, filters
 from pyrogram.types import (
-    InlineKeyboardMarkup, 
-    InlineKeyboardButton,
     ChatJoinRequest,
     Message,
     ChatPrivileges
@@ -16,313 +14,239 @@ from pyrogram.errors import (
     ChatWriteForbidden
 )
 from pyrogram.enums import ChatType, ChatMemberStatus
+from pyrogram.handlers.handler import Handler
 import asyncio
-import random
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import tempfile
 import logging
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, PyMongoError
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+from database import Database
+from write_buffer import WriteBehindBuffer
+from broadcast import (
+    BroadcastEngine,
+    RetryPolicy,
+    TokenBucket,
+    GLOBAL_RATE,
+    PRIVATE_CHAT_INTERVAL,
+    GROUP_CHAT_INTERVAL,
+    UNREACHABLE_ERRORS,
+    unreachable_reason
 )
-logger = logging.getLogger(__name__)
-
-# Initialize bot with your credentials
-app = Client(
-    "auto_approver_bot",
-    api_id=os.environ.get("TELEGRAM_API_ID"),
-    api_hash=os.environ.get("TELEGRAM_API_HASH"),
-    bot_token=os.environ.get("TELEGRAM_BOT_TOKEN")
+from jobs import BroadcastJobManager, BroadcastTarget, parse_job_id
+from chunks import ChunkQueue
+from media_cache import MediaCache
+from templates import JOIN, START, TemplateStore
+from sending import PreparedSend
+from work_queue import WorkQueue
+from sweep import JoinRequestSweeper
+from shards import Shard, ShardSet
+from application import Application
+from seen_cache import RecentlySeenCache
+from approvals import ApprovalScheduler
+from logs import parse_rates, setup_logging
+from stats import StatsService
+from exports import COLLECTIONS, export_collection, import_collection
+from metrics import (
+    FLOOD_WAIT_SECONDS,
+    FLOOD_WAITS,
+    JOIN_REQUESTS,
+    SENDS,
+    MetricsServer
 )
 
-class Database:
-    def __init__(self, mongo_uri):
-        """
-        Initialize MongoDB database connection
-        
-        :param mongo_uri: MongoDB connection string
-        """
-        try:
-            # Configure logging
-            logging.basicConfig(
-                level=logging.INFO,
-                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-            )
-            self.logger = logging.getLogger(__name__)
-
-            # Connect to MongoDB
-            self.client = MongoClient(mongo_uri)
-            
-            # Select the database
-            self.db = self.client.ApproveBot
-
-            # Define collections
-            self.users_collection = self.db.users
-            self.channels_collection = self.db.channels
-            self.groups_collection = self.db.groups
-
-            # Test connection
-            self.client.admin.command('ping')
-            self.logger.info("Successfully connected to MongoDB")
-
-        except ConnectionFailure:
-            self.logger.error("Failed to connect to MongoDB. Check your connection string.")
-            raise
-        except Exception as e:
-            self.logger.error(f"An error occurred while setting up MongoDB: {e}")
-            raise
-
-    def add_user(self, user_id: int, username: str):
-        """
-        Add a new user or update existing user in the database
-        
-        :param user_id: Telegram user ID
-        :param username: Telegram username
-        """
-        try:
-            # Upsert operation: insert if not exists, update if exists
-            self.users_collection.update_one(
-                {'user_id': user_id},
-                {'$set': {
-                    'username': username,
-                    'last_seen': datetime.now()
-                }},
-                upsert=True
-            )
-            self.logger.info(f"User {user_id} added/updated successfully")
-        except PyMongoError as e:
-            self.logger.error(f"Error adding user {user_id}: {e}")
-
-    def add_channel(self, user_id: int, channel_name: str, chat_id: int):
-        """
-        Add a channel to the database
-        
-        :param user_id: ID of user who added the channel
-        :param channel_name: Name of the channel
-        :param chat_id: Telegram chat ID of the channel
-        """
-        try:
-            # Upsert operation for channels
-            self.channels_collection.update_one(
-                {'chat_id': chat_id},
-                {'$set': {
-                    'name': channel_name,
-                    'added_by': user_id,
-                    'added_date': datetime.now()
-                }},
-                upsert=True
-            )
-            self.logger.info(f"Channel {channel_name} added successfully")
-        except PyMongoError as e:
-            self.logger.error(f"Error adding channel {channel_name}: {e}")
-
-    def add_group(self, user_id: int, group_name: str, group_id: int):
-        """
-        Add a group to the database
-        
-        :param user_id: ID of user who added the group
-        :param group_name: Name of the group
-        :param group_id: Telegram chat ID of the group
-        """
-        try:
-            # Upsert operation for groups
-            self.groups_collection.update_one(
-                {'chat_id': group_id},
-                {'$set': {
-                    'name': group_name,
-                    'added_by': user_id,
-                    'added_date': datetime.now()
-                }},
-                upsert=True
-            )
-            self.logger.info(f"Group {group_name} added successfully")
-        except PyMongoError as e:
-            self.logger.error(f"Error adding group {group_name}: {e}")
+logger = logging.getLogger(__name__)
 
-    def get_all_users(self):
-        """
-        Retrieve all users from the database
-        
-        :return: List of user IDs
-        """
-        try:
-            users = list(self.users_collection.find({}, {'user_id': 1}))
-            return [user['user_id'] for user in users]
-        except PyMongoError as e:
-            self.logger.error(f"Error retrieving users: {e}")
-            return []
-
-    def get_all_groups(self):
-        """
-        Retrieve all group chat IDs from the database
-        
-        :return: List of group chat IDs
-        """
-        try:
-            groups = list(self.groups_collection.find({}, {'chat_id': 1}))
-            return [group['chat_id'] for group in groups]
-        except PyMongoError as e:
-            self.logger.error(f"Error retrieving groups: {e}")
-            return []
-
-    def __del__(self):
-        """
-        Close MongoDB connection when object is deleted
-        """
-        if hasattr(self, 'client'):
-            self.client.close()
-            self.logger.info("MongoDB connection closed")
-
-# Replace the old database initialization
-db = Database(os.environ.get("MONGO_URI"))
-
-# Keyboard Generators
-def get_welcome_keyboard():
-    bot_username = "AutoAccepterSmartBot"  # Replace with your bot's username
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ Add me to your channel", url=f"https://t.me/{bot_username}?startchannel=true")],
-        [InlineKeyboardButton("➕ Add me to your Group", url=f"https://t.me/{bot_username}?startgroup=true")],
-        [
-            InlineKeyboardButton("👥 Support", url="https://t.me/SmokieOfficial"),
-            InlineKeyboardButton("👨‍💻 Owner", url="https://t.me/Hmm_Smokie")
-        ]
-    ])
+# Admin-only commands
+admin_filter = filters.user(1949883614)  # Replace with your Telegram user ID
 
-def get_approval_keyboard(support_channel):
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("👥 Join Support Channel", url=support_channel)]
-    ])
+async def send_template(client, chat_id, template, text):
+    """
+    Send a rendered template, with its video when it has one
+    """
+    reply_markup = template.reply_markup(client.me.username)
+    if template.video_url:
+        # Welcome videos are sent by file_id after the first upload
+        return await client.application.media_cache.send_video(
+            client,
+            chat_id,
+            template.video_url,
+            caption=text,
+            reply_markup=reply_markup
+        )
+    return await client.send_message(chat_id, text, reply_markup=reply_markup)
 
 # Command Handlers
-@app.on_message(filters.command("start"))
+@Client.on_message(filters.command("start"))
 async def start_command(client, message: Message):
     try:
-        user_id = message.from_user.id
-        username = message.from_user.username or message.from_user.first_name
+        user = message.from_user
+        username = user.username or user.first_name
+        application = client.application
         
-        db.add_user(user_id, username)
-        
-        welcome_text = (
-           "👋 𝐖𝐞𝐥𝐜𝐨𝐦𝐞 𝐭𝐨 𝐭𝐡𝐞 𝐀𝐮𝐭𝐨 𝐀𝐩𝐩𝐫𝐨𝐯𝐞𝐫 𝐁𝐨𝐭\n\n"
-
-            "ɪ'ᴍ ʜᴇʀᴇ ᴛᴏ ʜᴇʟᴘ ʏᴏᴜ ᴍᴀɴᴀɢᴇ ʏᴏᴜʀ ᴄʜᴀɴɴᴇʟ ᴀɴᴅ ɢʀᴏᴜᴘ ᴍᴇᴍʙᴇʀꜱ ᴀᴜᴛᴏᴍᴀᴛɪᴄᴀʟʟʏ.\n\n"
-
-            "ᴄʟɪᴄᴋ ᴛʜᴇ ʙᴜᴛᴛᴏɴ ʙᴇʟᴏᴡ ᴛᴏ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ᴄʜᴀɴɴᴇʟꜱ ᴏʀ ɢʀᴏᴜᴘꜱ., ᴀɴᴅ ʟᴇᴛ ᴍᴇ ʜᴀɴᴅʟᴇ ᴛʜᴇ ʀᴇꜱᴛ!\n"
-        )
+        await application.writer.add_user(user.id, username, client.me.id)
         
-        # Send video along with the welcome message
-        video_url = "https://cdn.glitch.global/04a38d5f-8c30-452e-b709-33da5c74b12d/175446-853577055.mp4?v=1732257487908"
-        await client.send_video(
-            chat_id=user_id,
-            video=video_url,
-            caption=welcome_text,
-            reply_markup=get_welcome_keyboard()
+        # Compiled once at startup, per chat customizations included
+        template = application.templates.get(START)
+        welcome_text = template.render(
+            first_name=user.first_name,
+            mention=f"@{user.username}" if user.username else user.first_name,
+            user_id=user.id
         )
+        await send_template(client, user.id, template, welcome_text)
     except Exception as e:
-        print(f"Error in start_command: {str(e)}")
+        logger.error(f"Error in start_command: {e}", extra={"event": "start_error", "user_id": message.from_user.id})
         await message.reply_text("An error occurred. Please try again later.")
 
 # Join Request Handler
-@app.on_chat_join_request()
+@Client.on_chat_join_request()
 async def handle_join_request(client, join_request: ChatJoinRequest):
+    application = client.application
     try:
-        user_id = join_request.from_user.id
-        chat_id = join_request.chat.id
-        username = join_request.from_user.username or join_request.from_user.first_name
-        chat_type = "channel" if join_request.chat.type == ChatType.CHANNEL else "group"
-        chat_title = join_request.chat.title
-        
-        # Auto-approve the request
-        await client.approve_chat_join_request(
-            chat_id=chat_id,
-            user_id=user_id
-        )
-        
-        # Update database
-        # Update database
-        db.add_user(user_id, username)
+        # With several bots in the chat, only the one assigned to it answers
+        if not application.shards.claims_chat(client, join_request.chat.id):
+            JOIN_REQUESTS.inc(outcome="skipped")
+            return
 
-        # Add channel or group for the user
-        if chat_type == "channel":
-            db.add_channel(user_id, chat_title, chat_id)
-        else:
-            db.add_group(user_id, chat_title, chat_id)
-        
-        # Send video and welcome message
-        support_channel = "https://t.me/SmokieOfficial"  # Configure this
-        
-        formatted_username = f"@{username}" if join_request.from_user.username else username
-        
-        welcome_message = (
-            f"𝐇𝐞𝐲 {formatted_username}! ✨\n\n"
-            f"𝗪𝗲𝗹𝗰𝗼𝗺𝗲 𝘁𝗼 𝗼𝘂𝗿 𝗰𝗼𝗺𝗺𝘂𝗻𝗶𝘁𝘆! 🎉\n"
-            f"●︎ ʏᴏᴜ ʜᴀᴠᴇ ʙᴇᴇɴ ᴀᴘᴘʀᴏᴠᴇᴅ ᴛᴏ ᴊᴏɪɴ **{chat_title}**!\n\n"
-            f"ᴘʟᴇᴀꜱᴇ ᴄᴏɴꜱɪᴅᴇʀ ᴊᴏɪɴɪɴɢ ᴏᴜʀ ꜱᴜᴘᴘᴏʀᴛ ᴄʜᴀɴɴᴇʟ ᴀꜱ ᴡᴇʟʟ. "
-        )
-        
-        video_url = "https://cdn.glitch.global/04a38d5f-8c30-452e-b709-33da5c74b12d/175446-853577055.mp4?v=1732257487908"
-        await client.send_video(
-            chat_id=user_id,
-            video=video_url,
-            caption=welcome_message,
-            reply_markup=get_approval_keyboard(support_channel)
-        )
+        # Auto-approve the request, paced per chat by the approval scheduler
+        if not await application.queue("approve").submit((client, join_request)):
+            JOIN_REQUESTS.inc(outcome="dropped")
     except Exception as e:
-        print(f"Error in handle_join_request: {str(e)}")
+        JOIN_REQUESTS.inc(outcome="error")
+        logger.error(f"Error in handle_join_request: {e}", extra={
+            "event": "join_request_error",
+            "chat_id": join_request.chat.id,
+            "user_id": join_request.from_user.id
+        })
+
+async def after_approval(client, join_request: ChatJoinRequest):
+    JOIN_REQUESTS.inc(outcome="approved")
+    application = client.application
+
+    # Persistence and the welcome DM run on their own workers so a slow
+    # DB write or DM never holds up the next approval
+    await application.queue("persist").submit((client, join_request))
+    await application.queue("welcome").submit((client, join_request))
+
+async def persist_join(item):
+    client, join_request = item
+    writer = client.application.writer
+    bot_id = client.me.id
+    user_id = join_request.from_user.id
+    chat_id = join_request.chat.id
+    username = join_request.from_user.username or join_request.from_user.first_name
+    chat_type = "channel" if join_request.chat.type == ChatType.CHANNEL else "group"
+    chat_title = join_request.chat.title
+
+    # Update database
+    await writer.add_user(user_id, username, bot_id)
+    # Which chat the user joined, for targeted broadcasts
+    await writer.add_membership(user_id, chat_id)
+    # Joins per day and per chat for /stats
+    writer.record_join(chat_id, chat_title)
+
+    # Keep the channel or group known; the joiner did not add it, so
+    # added_by is left alone
+    if chat_type == "channel":
+        await writer.add_channel(None, chat_title, chat_id, bot_id)
+    else:
+        await writer.add_group(None, chat_title, chat_id, bot_id)
+
+async def send_join_welcome(item):
+    client, join_request = item
+    application = client.application
+    user = join_request.from_user
+    chat = join_request.chat
+
+    # The chat's own welcome if it has one, else the default
+    template = application.templates.get(JOIN, chat.id)
+    welcome_message = template.render(
+        first_name=user.first_name,
+        mention=f"@{user.username}" if user.username else user.first_name,
+        user_id=user.id,
+        chat_title=chat.title,
+        chat_id=chat.id
+    )
+    
+    # Welcome DMs share the bot's global send budget with broadcasts
+    bucket = application.shards.for_client(client).bucket
+    await bucket.acquire()
+    try:
+        await send_template(client, user.id, template, welcome_message)
+        SENDS.inc(kind="welcome", outcome="delivered")
+    except UNREACHABLE_ERRORS as e:
+        SENDS.inc(kind="welcome", outcome="unreachable")
+        application.writer.mark_user_unreachable(user.id, unreachable_reason(e))
+    except FloodWait as e:
+        # Back off every sender on this token, broadcasts included
+        bucket.pause(e.value)
+        FLOOD_WAITS.inc(source="welcome")
+        FLOOD_WAIT_SECONDS.inc(e.value, source="welcome")
+        SENDS.inc(kind="welcome", outcome="failed")
+        raise
+    except Exception:
+        SENDS.inc(kind="welcome", outcome="failed")
+        raise
+
+# Matches service messages where the bot itself is among the new members.
+# client.me is resolved once by client.start(), so other membership events
+# are dropped here without an API call or a handler invocation.
+bot_added = filters.create(
+    lambda _, client, message: any(member.id == client.me.id for member in message.new_chat_members)
+)
 
-@app.on_message(filters.new_chat_members)
+@Client.on_message(filters.new_chat_members & bot_added)
 async def on_new_chat_member(client, message: Message):
     try:
-        bot_info = await client.get_me()  # Get bot's information
-        if bot_info.id in [member.id for member in message.new_chat_members]:
-            # Bot was added to the chat
-            chat_id = message.chat.id
-            chat_title = message.chat.title or "Unknown Chat"
-            chat_type = "channel" if message.chat.type == ChatType.CHANNEL else "group"
-            
-            # Log or print debug info
-            print(f"Bot added to {chat_type}: {chat_title} (ID: {chat_id})")
-
-            # Update database with the channel or group info
-            if chat_type == "channel":
-                db.add_channel(
-                    user_id=message.from_user.id,  # Admin or owner who added the bot
-                    channel_name=chat_title,
-                    chat_id=chat_id
-                )
-            else:  # chat_type == "group"
-                db.add_group(
-                    user_id=message.from_user.id,
-                    group_name=chat_title,
-                    group_id=chat_id
-                )
-
-            # Also add new members to user database
-            for member in message.new_chat_members:
-                # Skip adding the bot itself
-                if member.id != bot_info.id:
-                    username = member.username or member.first_name
-                    db.add_user(member.id, username)
-
-            # Send welcome message to the user who added the bot in private
-            try:
-                await client.send_message(
-                    chat_id=message.from_user.id,
-                    text=f"🤖 𝐁𝐨𝐭 𝐀𝐝𝐝𝐞𝐝 𝐒𝐮𝐜𝐜𝐞𝐬𝐬𝐟𝐮𝐥𝐥𝐲!\n\n"
-                         f"👥 𝐂𝐡𝐚𝐭 𝐍𝐚𝐦𝐞: **{chat_title}**\n"
-                         f"🌟 𝐓𝐡𝐞 𝐛𝐨𝐭 𝐢𝐬 𝐧𝐨𝐰 𝐫𝐞𝐚𝐝𝐲 𝐭𝐨 𝐚𝐮𝐭𝐨𝐦𝐚𝐭𝐞 𝐭𝐡𝐢𝐬 {chat_type}."
-                )
-            except Exception as private_msg_error:
-                print(f"Could not send private message: {private_msg_error}")
+        writer = client.application.writer
+        bot_id = client.me.id
+        # Bot was added to the chat
+        chat_id = message.chat.id
+        chat_title = message.chat.title or "Unknown Chat"
+        chat_type = "channel" if message.chat.type == ChatType.CHANNEL else "group"
+        
+        # Log or print debug info
+        logger.info(f"Bot added to {chat_type}: {chat_title} (ID: {chat_id})",
+                    extra={"event": "bot_added", "chat_id": chat_id, "user_id": message.from_user.id})
+
+        # Update database with the channel or group info
+        if chat_type == "channel":
+            await writer.add_channel(
+                user_id=message.from_user.id,  # Admin or owner who added the bot
+                channel_name=chat_title,
+                chat_id=chat_id,
+                bot_id=bot_id
+            )
+        else:  # chat_type == "group"
+            await writer.add_group(
+                user_id=message.from_user.id,
+                group_name=chat_title,
+                group_id=chat_id,
+                bot_id=bot_id
+            )
+
+        # Also add new members to user database in one batch, skipping the bot itself
+        await writer.add_users(
+            (member.id, member.username or member.first_name)
+            for member in message.new_chat_members
+            if member.id != bot_id
+        )
+
+        # Send welcome message to the user who added the bot in private
+        try:
+            await client.send_message(
+                chat_id=message.from_user.id,
+                text=f"🤖 𝐁𝐨𝐭 𝐀𝐝𝐝𝐞𝐝 𝐒𝐮𝐜𝐜𝐞𝐬𝐬𝐟𝐮𝐥𝐥𝐲!\n\n"
+                     f"👥 𝐂𝐡𝐚𝐭 𝐍𝐚𝐦𝐞: **{chat_title}**\n"
+                     f"🌟 𝐓𝐡𝐞 𝐛𝐨𝐭 𝐢𝐬 𝐧𝐨𝐰 𝐫𝐞𝐚𝐝𝐲 𝐭𝐨 𝐚𝐮𝐭𝐨𝐦𝐚𝐭𝐞 𝐭𝐡𝐢𝐬 {chat_type}."
+            )
+        except Exception as private_msg_error:
+            logger.warning(f"Could not send private message: {private_msg_error}",
+                           extra={"event": "bot_added_dm_failed", "user_id": message.from_user.id})
 
     except Exception as e:
-        print(f"Error in on_new_chat_member: {str(e)}")
+        logger.error(f"Error in on_new_chat_member: {e}", extra={"event": "bot_added_error", "chat_id": message.chat.id})
 
-@app.on_message(filters.command("broadcast") & filters.user(1949883614))  # Replace with your Telegram user ID
+@Client.on_message(filters.command("broadcast") & admin_filter)
 async def broadcast_message(client, message: Message):
     """
     Broadcast a message or media to all users in the database.
@@ -334,147 +258,19 @@ async def broadcast_message(client, message: Message):
             await message.reply_text("Please reply to a message or send a message to broadcast.")
             return
 
-        # Get the list of unique user IDs from the users database
-        user_ids = db.get_all_users()
-        
-        # Randomize the order to avoid potential rate limits
-        random.shuffle(user_ids)
-        
-        # Track broadcast statistics
-        successful_broadcasts = 0
-        failed_broadcasts = 0
-        blocked_users = 0
-
         # Progress message
         progress_message = await message.reply_text("Starting broadcast... 0%")
-        
-        # Function to send a single broadcast
-        async def send_broadcast(user_id):
-            nonlocal successful_broadcasts, failed_broadcasts, blocked_users
-            try:
-                # Determine the source message (reply or original)
-                source_msg = message.reply_to_message or message
-
-                # Prepare common parameters
-                caption = source_msg.caption or source_msg.text or ""
-                reply_markup = source_msg.reply_markup
-
-                # Media sending methods mapping
-                media_methods = {
-                    'photo': client.send_photo,
-                    'video': client.send_video,
-                    'document': client.send_document,
-                    'audio': client.send_audio,
-                    'voice': client.send_voice,
-                    'animation': client.send_animation,
-                    'sticker': client.send_sticker,
-                    'video_note': client.send_video_note
-                }
-
-                # Detect and send media
-                sent_message = None
-                if source_msg.photo:
-                    sent_message = await client.send_photo(
-                        chat_id=user_id,
-                        photo=source_msg.photo.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.video:
-                    sent_message = await client.send_video(
-                        chat_id=user_id,
-                        video=source_msg.video.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.document:
-                    sent_message = await client.send_document(
-                        chat_id=user_id,
-                        document=source_msg.document.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.audio:
-                    sent_message = await client.send_audio(
-                        chat_id=user_id,
-                        audio=source_msg.audio.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.voice:
-                    sent_message = await client.send_voice(
-                        chat_id=user_id,
-                        voice=source_msg.voice.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.animation:
-                    sent_message = await client.send_animation(
-                        chat_id=user_id,
-                        animation=source_msg.animation.file_id,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.sticker:
-                    sent_message = await client.send_sticker(
-                        chat_id=user_id,
-                        sticker=source_msg.sticker.file_id,
-                        reply_markup=reply_markup
-                    )
-                elif source_msg.video_note:
-                    sent_message = await client.send_video_note(
-                        chat_id=user_id,
-                        video_note=source_msg.video_note.file_id,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    # If no media, send as a text message with keyboard
-                    sent_message = await client.send_message(
-                        chat_id=user_id,
-                        text=caption,
-                        reply_markup=reply_markup
-                    )
-                
-                successful_broadcasts += 1
-            except FloodWait as e:
-                # Handle Telegram's flood wait
-                print(f"Flood wait for {e.value} seconds")
-                await asyncio.sleep(e.value)
-                return False
-            except (UserIsBlocked, PeerIdInvalid):
-                blocked_users += 1
-                return False
-            except Exception as e:
-                failed_broadcasts += 1
-                print(f"Error broadcasting to {user_id}: {str(e)}")
-                return False
-            return True
-
-        # Broadcast to users with rate limiting and error handling
-        for i, user_id in enumerate(user_ids, 1):
-            # Send broadcast
-            result = await send_broadcast(user_id)
-            
-            # Update progress every 10 users
-            if i % 10 == 0:
-                progress = (i / len(user_ids)) * 100
-                await progress_message.edit_text(f"Broadcast progress: {progress:.2f}%")
-            
-            # Add a small delay between broadcasts to avoid rate limits
-            await asyncio.sleep(0.5)
-
-        # Final report
-        await progress_message.edit_text(
-            f"📊 Broadcast Completed!\n\n"
-            f"✅ Successful: {successful_broadcasts}\n"
-            f"❌ Failed: {failed_broadcasts}\n"
-            f"🚫 Blocked Users: {blocked_users}"
-        )
+
+        # Determine the source message (reply or original)
+        source_msg = message.reply_to_message or message
+
+        # The job runs in the background and keeps the progress message updated
+        await client.application.job_manager.create(client, "users", source_msg, progress_message)
 
     except Exception as e:
         await message.reply_text(f"Broadcast failed: {str(e)}")
 
-@app.on_message(filters.command("broadcastgrp") & filters.user(1949883614))  # Replace with your Telegram user ID
+@Client.on_message(filters.command("broadcastgrp") & admin_filter)
 async def broadcast_to_groups(client, message: Message):
     """
     Broadcast a message or media to all groups in the database.
@@ -486,142 +282,542 @@ async def broadcast_to_groups(client, message: Message):
             await message.reply_text("Please reply to a message or send a message to broadcast to groups.")
             return
 
-        # New code
-        group_ids = db.get_all_groups()
-        
-        # Randomize the order to avoid potential rate limits
-        random.shuffle(group_ids)
-        
-        # Track broadcast statistics
-        successful_broadcasts = 0
-        failed_broadcasts = 0
-        restricted_groups = 0
-
         # Progress message
         progress_message = await message.reply_text("Starting group broadcast... 0%")
-        
-        # Function to send a single group broadcast
-        async def send_group_broadcast(group_id):
-            nonlocal successful_broadcasts, failed_broadcasts, restricted_groups
-            try:
-                # Determine the source message (reply or original)
-                source_msg = message.reply_to_message or message
-
-                # Prepare common parameters
-                caption = source_msg.caption or source_msg.text or ""
-                reply_markup = source_msg.reply_markup
-
-                # Comprehensive media sending method
-                try:
-                    if source_msg.photo:
-                        sent_message = await client.send_photo(
-                            chat_id=group_id,
-                            photo=source_msg.photo.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.video:
-                        sent_message = await client.send_video(
-                            chat_id=group_id,
-                            video=source_msg.video.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.document:
-                        sent_message = await client.send_document(
-                            chat_id=group_id,
-                            document=source_msg.document.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.audio:
-                        sent_message = await client.send_audio(
-                            chat_id=group_id,
-                            audio=source_msg.audio.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.voice:
-                        sent_message = await client.send_voice(
-                            chat_id=group_id,
-                            voice=source_msg.voice.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.animation:
-                        sent_message = await client.send_animation(
-                            chat_id=group_id,
-                            animation=source_msg.animation.file_id,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.sticker:
-                        # Stickers don't support captions, so send sticker first, then message
-                        await client.send_sticker(
-                            chat_id=group_id,
-                            sticker=source_msg.sticker.file_id
-                        )
-                        sent_message = await client.send_message(
-                            chat_id=group_id,
-                            text=caption,
-                            reply_markup=reply_markup
-                        )
-                    elif source_msg.video_note:
-                        sent_message = await client.send_video_note(
-                            chat_id=group_id,
-                            video_note=source_msg.video_note.file_id
-                        )
-                        # Send caption as a separate message if exists
-                        if caption:
-                            await client.send_message(
-                                chat_id=group_id,
-                                text=caption,
-                                reply_markup=reply_markup
-                            )
-                    else:
-                        # Fallback to text message if no media
-                        sent_message = await client.send_message(
-                            chat_id=group_id,
-                            text=caption,
-                            reply_markup=reply_markup
-                        )
-                    
-                    successful_broadcasts += 1
-                    return True
-
-                except Exception as send_error:
-                    print(f"Error sending to group {group_id}: {str(send_error)}")
-                    failed_broadcasts += 1
-                    return False
-
-            except Exception as e:
-                print(f"Unexpected error with group {group_id}: {str(e)}")
-                failed_broadcasts += 1
-                return False
-
-        # Broadcast to groups with rate limiting and error handling
-        for i, group_id in enumerate(group_ids, 1):
-            # Send broadcast
-            result = await send_group_broadcast(group_id)
-            
-            # Update progress every 10 groups
-            if i % 10 == 0:
-                progress = (i / len(group_ids)) * 100
-                await progress_message.edit_text(f"Group Broadcast progress: {progress:.2f}%")
-            
-            # Add a small delay between broadcasts to avoid rate limits
-            await asyncio.sleep(0.5)
-
-        # Final report
-        await progress_message.edit_text(
-            f"📊 Group Broadcast Completed!\n\n"
-            f"✅ Successful: {successful_broadcasts}\n"
-            f"❌ Failed: {failed_broadcasts}"
-        )
+
+        # Determine the source message (reply or original)
+        source_msg = message.reply_to_message or message
+
+        # The job runs in the background and keeps the progress message updated
+        await client.application.job_manager.create(client, "groups", source_msg, progress_message)
 
     except Exception as e:
         await message.reply_text(f"Group Broadcast failed: {str(e)}")
-        print(f"Unexpected broadcast error: {str(e)}")
+        logger.error(f"Unexpected broadcast error: {e}", extra={"event": "broadcast_command_error"})
+
+@Client.on_message(filters.command("broadcastchat") & admin_filter)
+async def broadcast_to_members(client, message: Message):
+    """
+    Broadcast a message to the users who joined one channel or group.
+    Usage: /broadcastchat <chat_id> [days], replying to the message to send;
+    with days, only users who joined within that many days are reached.
+    """
+    try:
+        if len(message.command) < 2:
+            await message.reply_text("Usage: /broadcastchat <chat_id> [days]")
+            return
+        try:
+            chat_id = int(message.command[1])
+            days = float(message.command[2]) if len(message.command) > 2 else None
+        except ValueError:
+            await message.reply_text("Usage: /broadcastchat <chat_id> [days]")
+            return
+
+        # Check if the message is a reply to another message or contains forwarded content
+        if not message.reply_to_message and not message.media:
+            await message.reply_text("Please reply to a message or send a message to broadcast.")
+            return
+
+        # Fixed at creation so a resumed job keeps the same audience
+        segment = {"chat_id": chat_id, "since": datetime.now() - timedelta(days=days) if days else None}
+
+        # Progress message
+        progress_message = await message.reply_text("Starting targeted broadcast... 0%")
+
+        # Determine the source message (reply or original)
+        source_msg = message.reply_to_message or message
+
+        # The job runs in the background and keeps the progress message updated
+        await client.application.job_manager.create(client, "members", source_msg, progress_message, segment)
+
+    except Exception as e:
+        await message.reply_text(f"Targeted broadcast failed: {str(e)}")
+
+def format_job(job):
+    stats = job.get("stats") or {}
+    segment = job.get("segment")
+    target = f"{job['target']} of {segment['chat_id']}" if segment else job["target"]
+    return (
+        f"🆔 {job['_id']} ({target})\n"
+        f"📌 Status: {job['status']}\n"
+        f"✅ {stats.get('delivered', 0)}  🚫 {stats.get('unreachable', 0)}  "
+        f"❌ {stats.get('failed', 0) + stats.get('dropped', 0)}\n"
+        f"🕒 Started: {job['created_at']:%Y-%m-%d %H:%M}"
+    )
+
+@Client.on_message(filters.command("bstatus") & admin_filter)
+async def broadcast_status(client, message: Message):
+    """
+    Show one broadcast job, or the most recent ones.
+    Usage: /bstatus [job_id]
+    """
+    job_manager = client.application.job_manager
+    try:
+        if len(message.command) > 1:
+            job_id = parse_job_id(message.command[1])
+            job = await job_manager.get(job_id) if job_id else None
+            if job is None:
+                await message.reply_text("No broadcast job with that ID.")
+                return
+            await message.reply_text(format_job(job))
+            return
+
+        jobs = await job_manager.recent()
+        if not jobs:
+            await message.reply_text("No broadcast jobs yet.")
+            return
+        await message.reply_text("\n\n".join(format_job(job) for job in jobs))
+    except Exception as e:
+        await message.reply_text(f"Could not fetch broadcast status: {str(e)}")
+
+@Client.on_message(filters.command(["bpause", "bresume", "bcancel"]) & admin_filter)
+async def broadcast_control(client, message: Message):
+    """
+    Pause, resume or cancel a broadcast job.
+    Usage: /bpause <job_id>, /bresume <job_id>, /bcancel <job_id>
+    """
+    job_manager = client.application.job_manager
+    try:
+        action = message.command[0]
+        job_id = parse_job_id(message.command[1]) if len(message.command) > 1 else None
+        if job_id is None:
+            await message.reply_text(f"Usage: /{action} <job_id>")
+            return
+
+        if action == "bpause":
+            done = await job_manager.pause(job_id)
+        elif action == "bresume":
+            done = await job_manager.resume(job_id)
+        else:
+            done = await job_manager.cancel(job_id)
+
+        verb = {"bpause": "paused", "bresume": "resumed", "bcancel": "cancelled"}[action]
+        if done:
+            await message.reply_text(f"Broadcast job {job_id} {verb}.")
+        else:
+            await message.reply_text(f"Broadcast job {job_id} could not be {verb} in its current state.")
+    except Exception as e:
+        await message.reply_text(f"Could not update broadcast job: {str(e)}")
+
+@Client.on_message(filters.command("queues") & admin_filter)
+async def queue_metrics(client, message: Message):
+    """
+    Show depth, lag and drop counts of the internal work queues.
+    """
+    lines = ["📥 Work Queues"]
+    for queue in client.application.queues:
+        stats = queue.stats()
+        lines.append(
+            f"\n{queue.name}: depth {stats['depth']}, processed {stats['processed']}, "
+            f"failed {stats['failed']}, dropped {stats['dropped']}, "
+            f"lag {stats['last_lag']:.2f}s (max {stats['max_lag']:.2f}s)"
+        )
+    busiest = client.application.queue("approve").chat_stats(limit=5)
+    if any(chat["pending"] or chat["in_flight"] for chat in busiest):
+        lines.append("\n🚦 Busiest chats")
+        for chat in busiest:
+            lines.append(
+                f"{chat['chat_id']}: pending {chat['pending']}, in flight {chat['in_flight']}/{chat['limit']:g}, "
+                f"flood waits {chat['flood_waits']}, lag {chat['last_lag']:.2f}s (max {chat['max_lag']:.2f}s)"
+            )
+    seen_cache = client.application.writer.seen_cache
+    if seen_cache is not None:
+        stats = seen_cache.stats()
+        lines.append(
+            f"\nseen users: {stats['size']} cached, {stats['hits']} writes skipped, "
+            f"{stats['misses']} written, hit ratio {stats['hit_ratio']:.1%}"
+        )
+    await message.reply_text("\n".join(lines))
+
+def format_sweep(cleared, failed):
+    total = sum(count for _, count in cleared.values())
+    lines = [
+        "🧹 Join Request Sweep Completed!\n",
+        f"✅ Approved: {total} in {len(cleared)} chats",
+        f"⚠️ Chats skipped: {failed}"
+    ]
+    # Largest backlogs first
+    for chat_id, (name, count) in sorted(cleared.items(), key=lambda item: -item[1][1])[:20]:
+        lines.append(f"• {name or chat_id}: {count}")
+    return "\n".join(lines)
+
+@Client.on_message(filters.command("sweep") & admin_filter)
+async def sweep_command(client, message: Message):
+    """
+    Approve pending join requests in every known chat.
+    """
+    application = client.application
+    sweeper = application.sweeper
+    try:
+        if sweeper.running:
+            await message.reply_text("A sweep is already running.")
+            return
+        progress_message = await message.reply_text("Sweeping pending join requests...")
+        cleared, failed = await sweeper.sweep(application.sweep_client or client)
+        await progress_message.edit_text(format_sweep(cleared, failed))
+    except Exception as e:
+        await message.reply_text(f"Sweep failed: {str(e)}")
+
+@Client.on_message(filters.command("reload") & admin_filter)
+async def reload_templates(client, message: Message):
+    """
+    Reload welcome templates now instead of waiting for the change check.
+    """
+    if await client.application.templates.load():
+        await message.reply_text("✅ Templates reloaded.")
+    else:
+        await message.reply_text("Templates could not be loaded; the previous ones are still in use.")
 
-print("Bot is running...")
-app.run()
+def default_templates(config):
+    """
+    Built-in welcome messages; the template file and collection override them
+    """
+    video_url = config.get(
+        "WELCOME_VIDEO_URL",
+        "https://cdn.glitch.global/04a38d5f-8c30-452e-b709-33da5c74b12d/175446-853577055.mp4?v=1732257487908"
+    )
+    support_url = config.get("SUPPORT_URL", "https://t.me/SmokieOfficial")
+    owner_url = config.get("OWNER_URL", "https://t.me/Hmm_Smokie")
+    return {
+        START: {
+            "text": (
+                "👋 𝐖𝐞𝐥𝐜𝐨𝐦𝐞 𝐭𝐨 𝐭𝐡𝐞 𝐀𝐮𝐭𝐨 𝐀𝐩𝐩𝐫𝐨𝐯𝐞𝐫 𝐁𝐨𝐭\n\n"
+
+                "ɪ'ᴍ ʜᴇʀᴇ ᴛᴏ ʜᴇʟᴘ ʏᴏᴜ ᴍᴀɴᴀɢᴇ ʏᴏᴜʀ ᴄʜᴀɴɴᴇʟ ᴀɴᴅ ɢʀᴏᴜᴘ ᴍᴇᴍʙᴇʀꜱ ᴀᴜᴛᴏᴍᴀᴛɪᴄᴀʟʟʏ.\n\n"
+
+                "ᴄʟɪᴄᴋ ᴛʜᴇ ʙᴜᴛᴛᴏɴ ʙᴇʟᴏᴡ ᴛᴏ ᴀᴅᴅ ᴍᴇ ᴛᴏ ʏᴏᴜʀ ᴄʜᴀɴɴᴇʟꜱ ᴏʀ ɢʀᴏᴜᴘꜱ., ᴀɴᴅ ʟᴇᴛ ᴍᴇ ʜᴀɴᴅʟᴇ ᴛʜᴇ ʀᴇꜱᴛ!\n"
+            ),
+            "video_url": video_url,
+            "buttons": [
+                [{"text": "➕ Add me to your channel", "url": "https://t.me/{bot_username}?startchannel=true"}],
+                [{"text": "➕ Add me to your Group", "url": "https://t.me/{bot_username}?startgroup=true"}],
+                [
+                    {"text": "👥 Support", "url": support_url},
+                    {"text": "👨‍💻 Owner", "url": owner_url}
+                ]
+            ]
+        },
+        JOIN: {
+            "text": (
+                "𝐇𝐞𝐲 {mention}! ✨\n\n"
+                "𝗪𝗲𝗹𝗰𝗼𝗺𝗲 𝘁𝗼 𝗼𝘂𝗿 𝗰𝗼𝗺𝗺𝘂𝗻𝗶𝘁𝘆! 🎉\n"
+                "●︎ ʏᴏᴜ ʜᴀᴠᴇ ʙᴇᴇɴ ᴀᴘᴘʀᴏᴠᴇᴅ ᴛᴏ ᴊᴏɪɴ **{chat_title}**!\n\n"
+                "ᴘʟᴇᴀꜱᴇ ᴄᴏɴꜱɪᴅᴇʀ ᴊᴏɪɴɪɴɢ ᴏᴜʀ ꜱᴜᴘᴘᴏʀᴛ ᴄʜᴀɴɴᴇʟ ᴀꜱ ᴡᴇʟʟ. "
+            ),
+            "video_url": video_url,
+            "buttons": [
+                [{"text": "👥 Join Support Channel", "url": support_url}]
+            ]
+        }
+    }
+
+def format_stats(summary):
+    lines = [
+        "📊 Bot Statistics\n",
+        f"👤 Users: {summary['users']}",
+        f"🚫 Blocked: {summary['blocked_users']} ({summary['blocked_ratio']:.1%})",
+        f"📢 Channels: {summary['channels']}",
+        f"👥 Groups: {summary['groups']} ({summary['restricted_groups']} restricted)",
+    ]
+    if summary["daily"]:
+        lines.append("\n📈 Joins per day")
+        for day in summary["daily"]:
+            lines.append(f"{day['day']}: {day.get('joins', 0)} joins, {day.get('new_users', 0)} new users")
+    if summary["top_chats"]:
+        lines.append("\n🏆 Top chats")
+        for chat in summary["top_chats"]:
+            lines.append(f"• {chat.get('name') or chat['chat_id']}: {chat['joins']}")
+    return "\n".join(lines)
+
+@Client.on_message(filters.command("stats") & admin_filter)
+async def stats_command(client, message: Message):
+    """
+    Show user, channel and group totals, recent joins and the busiest chats.
+    Usage: /stats, or /stats rebuild to recompute the rollups
+    """
+    stats = StatsService(client.application.db)
+    try:
+        if len(message.command) > 1 and message.command[1] == "rebuild":
+            progress_message = await message.reply_text("Rebuilding stats rollups...")
+            await stats.rebuild()
+            await progress_message.edit_text(format_stats(await stats.summary()))
+            return
+        await message.reply_text(format_stats(await stats.summary()))
+    except Exception as e:
+        await message.reply_text(f"Could not fetch stats: {str(e)}")
+
+@Client.on_message(filters.command("export") & admin_filter)
+async def export_command(client, message: Message):
+    """
+    Send a collection as a compressed JSON lines file.
+    Usage: /export <users|channels|groups|memberships>
+    """
+    name = message.command[1] if len(message.command) > 1 else None
+    if name not in COLLECTIONS:
+        await message.reply_text(f"Usage: /export <{'|'.join(COLLECTIONS)}>")
+        return
+    # Unique per export, so two started in the same second do not collide
+    fd, path = tempfile.mkstemp(prefix=f"{name}-{datetime.now():%Y%m%d-%H%M%S}-", suffix=".jsonl.gz")
+    os.close(fd)
+    try:
+        progress_message = await message.reply_text(f"Exporting {name}...")
+        count = await export_collection(client.application.db, name, path)
+        await message.reply_document(path, caption=f"📦 {count} {name}")
+        await progress_message.delete()
+    except Exception as e:
+        await message.reply_text(f"Export failed: {str(e)}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+@Client.on_message(filters.command("import") & admin_filter)
+async def import_command(client, message: Message):
+    """
+    Upsert documents from a file made by /export.
+    Usage: reply to the file with /import <users|channels|groups|memberships>
+    """
+    name = message.command[1] if len(message.command) > 1 else None
+    document = message.reply_to_message.document if message.reply_to_message else None
+    if name not in COLLECTIONS or document is None:
+        await message.reply_text(f"Reply to an export file with /import <{'|'.join(COLLECTIONS)}>")
+        return
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=".jsonl.gz")
+    os.close(fd)
+    try:
+        progress_message = await message.reply_text(f"Importing {name}...")
+        await message.reply_to_message.download(file_name=path)
+        count = await import_collection(client.application.db, name, path)
+        if name == "memberships":
+            # The join rollups are derived from memberships
+            await StatsService(client.application.db).rebuild()
+        await progress_message.edit_text(f"✅ Imported {count} {name}.")
+    except Exception as e:
+        await message.reply_text(f"Import failed: {str(e)}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def collect_handlers():
+    """
+    Every handler defined in this module with the Client.on_* decorators
+
+    The decorators leave a list of (Handler, group) pairs on the function;
+    other objects with a handlers list, such as loggers, are skipped.
+    """
+    def decorated(func):
+        handlers = getattr(func, "handlers", None)
+        return callable(func) and isinstance(handlers, list) and bool(handlers) and all(
+            isinstance(entry, tuple) and len(entry) == 2 and isinstance(entry[0], Handler)
+            for entry in handlers
+        )
+
+    return [func for func in globals().values() if decorated(func)]
+
+def create_app(config=None, clients=None, db=None):
+    """
+    Build the bot from configuration without connecting anything
+
+    :param config: Mapping of settings, os.environ by default
+    :param clients: Bot clients to serve; built from the TELEGRAM_* settings if None
+    :param db: Database to use; built from MONGO_URI if None
+    :return: Application ready for run()
+    """
+    config = os.environ if config is None else config
+    # A worker only sends chunks of broadcasts; it takes no updates or commands
+    worker = config.get("ROLE", "bot") == "worker"
+    worker_name = config.get("WORKER_NAME", "worker" if worker else "bot")
+
+    if clients is None:
+        # Worker processes log in with their own sessions of the same bots
+        session = f"auto_approver_{worker_name}" if worker else "auto_approver_bot"
+        # Initialize bot with your credentials
+        clients = [Client(
+            session,
+            api_id=config.get("TELEGRAM_API_ID"),
+            api_hash=config.get("TELEGRAM_API_HASH"),
+            bot_token=config.get("TELEGRAM_BOT_TOKEN"),
+            no_updates=worker
+        )]
+        # Extra bot tokens served from the same process, each with its own session
+        clients += [
+            Client(
+                f"{session}_{index}",
+                api_id=config.get("TELEGRAM_API_ID"),
+                api_hash=config.get("TELEGRAM_API_HASH"),
+                bot_token=token.strip(),
+                no_updates=worker
+            )
+            for index, token in enumerate(config.get("TELEGRAM_BOT_TOKENS", "").split(","), start=1)
+            if token.strip()
+        ]
+
+    # Optional admin user session for the join-request sweep: Telegram only lets
+    # user accounts list and bulk-approve pending requests
+    sweep_client = Client(
+        "auto_approver_sweeper",
+        api_id=config.get("TELEGRAM_API_ID"),
+        api_hash=config.get("TELEGRAM_API_HASH"),
+        session_string=config.get("SWEEP_SESSION_STRING"),
+        no_updates=True
+    ) if config.get("SWEEP_SESSION_STRING") and not worker else None
+
+    if db is None:
+        db = Database(
+            config.get("MONGO_URI"),
+            blocked_retention_days=float(config["BLOCKED_USER_RETENTION_DAYS"]) if config.get("BLOCKED_USER_RETENTION_DAYS") else None
+        )
+
+    # Coalesces the per-event upserts into periodic bulk writes
+    writer = WriteBehindBuffer(
+        db,
+        flush_interval=float(config.get("DB_FLUSH_INTERVAL", 0.5)),
+        max_pending=int(config.get("DB_FLUSH_MAX_PENDING", 1000)),
+        # Drops user upserts repeated within the freshness window
+        seen_cache=RecentlySeenCache(
+            max_entries=int(config.get("SEEN_CACHE_SIZE", 100000)),
+            freshness=float(config.get("SEEN_CACHE_TTL", 300))
+        )
+    )
+
+    # One bucket per bot token: broadcasts and welcome DMs share its global send budget
+    shards = ShardSet([
+        Shard(index, client, TokenBucket(float(config.get("BROADCAST_RATE", GLOBAL_RATE))))
+        for index, client in enumerate(clients)
+    ])
+
+    broadcast_engine = BroadcastEngine(
+        [shard.bucket for shard in shards],
+        workers=int(config.get("BROADCAST_WORKERS", 20)),
+        retry_policy=RetryPolicy(
+            max_attempts=int(config.get("BROADCAST_MAX_ATTEMPTS", 5)),
+            deadline=float(config["BROADCAST_DEADLINE"]) if config.get("BROADCAST_DEADLINE") else None
+        )
+    )
+
+    # Broadcasts run as persisted jobs so a restart resumes instead of re-sending
+    job_manager = BroadcastJobManager(
+        db,
+        broadcast_engine,
+        targets={
+            "users": BroadcastTarget(
+                # Stream user IDs in a random order straight from the cursor,
+                # with the bots that can reach each user for lane routing
+                recipients=lambda job: db.iter_user_ids(with_bots=True),
+                count=lambda job: db.count_users(),
+                make_sender=PreparedSend,
+                chat_interval=PRIVATE_CHAT_INTERVAL,
+                title="Broadcast",
+                unreachable_label="Blocked Users",
+                # Flag dead recipients so later broadcasts skip them
+                on_unreachable=writer.mark_user_unreachable
+            ),
+            "members": BroadcastTarget(
+                # Only users who joined the job's chat, streamed from the
+                # membership index
+                recipients=lambda job: db.iter_member_ids(
+                    job["segment"]["chat_id"], since=job["segment"].get("since"), with_bots=True
+                ),
+                count=lambda job: db.count_members(job["segment"]["chat_id"], since=job["segment"].get("since")),
+                make_sender=PreparedSend,
+                chat_interval=PRIVATE_CHAT_INTERVAL,
+                title="Targeted Broadcast",
+                unreachable_label="Blocked Users",
+                on_unreachable=writer.mark_user_unreachable
+            ),
+            "groups": BroadcastTarget(
+                recipients=lambda job: db.iter_group_ids(with_bots=True),
+                count=lambda job: db.count_groups(),
+                make_sender=PreparedSend,
+                chat_interval=GROUP_CHAT_INTERVAL,
+                title="Group Broadcast",
+                unreachable_label="Restricted",
+                on_unreachable=writer.mark_group_unreachable
+            )
+        },
+        shards=shards,
+        progress_interval=float(config.get("BROADCAST_PROGRESS_INTERVAL", 5)),
+        # With a chunk size, broadcasts are split into chunks that this and
+        # every worker process claim from MongoDB
+        chunks=ChunkQueue(
+            db,
+            lease_seconds=float(config.get("BROADCAST_CHUNK_LEASE", 60))
+        ) if worker or int(config.get("BROADCAST_CHUNK_SIZE", 0)) else None,
+        chunk_size=int(config.get("BROADCAST_CHUNK_SIZE", 0)) or 5000,
+        worker_name=worker_name
+    )
+
+    # Bounded queues behind the join handler
+    queues = [
+        ApprovalScheduler(
+            on_approved=after_approval,
+            workers=int(config.get("APPROVE_WORKERS", 16)),
+            initial_limit=float(config.get("APPROVE_CHAT_CONCURRENCY", 2)),
+            max_limit=float(config.get("APPROVE_CHAT_MAX_CONCURRENCY", 10)),
+            max_pending_per_chat=int(config.get("APPROVE_QUEUE_SIZE", 10000))
+        ),
+        WorkQueue(
+            "persist",
+            persist_join,
+            workers=int(config.get("PERSIST_WORKERS", 2)),
+            maxsize=int(config.get("PERSIST_QUEUE_SIZE", 10000)),
+            put_timeout=1.0
+        ),
+        WorkQueue(
+            "welcome",
+            send_join_welcome,
+            workers=int(config.get("WELCOME_WORKERS", 8)),
+            maxsize=int(config.get("WELCOME_QUEUE_SIZE", 5000))
+        )
+    ]
+
+    return Application(
+        clients=clients,
+        db=db,
+        writer=writer,
+        # Welcome videos are sent by file_id after the first upload
+        media_cache=MediaCache(db),
+        # Welcome messages compiled once and reloaded when they change
+        templates=TemplateStore(
+            db,
+            default_templates(config),
+            path=config.get("TEMPLATES_FILE"),
+            reload_interval=float(config.get("TEMPLATES_RELOAD_INTERVAL", 60))
+        ),
+        shards=shards,
+        job_manager=job_manager,
+        # Approves join requests that piled up while the bot was down
+        sweeper=JoinRequestSweeper(db, rate=float(config.get("SWEEP_RATE", 1))),
+        queues=queues,
+        handlers=[] if worker else collect_handlers(),
+        # Local Prometheus scrape endpoint; METRICS_PORT=0 turns it off
+        metrics_server=MetricsServer(
+            host=config.get("METRICS_HOST", "127.0.0.1"),
+            port=int(config.get("METRICS_PORT", 9464))
+        ),
+        sweep_client=sweep_client,
+        # Bots cannot list pending requests, so by default only sweep with a user session
+        sweep_on_startup=not worker and config.get("SWEEP_ON_STARTUP", "1" if sweep_client else "0") == "1",
+        resume_jobs=not worker,
+        shutdown_timeout=float(config.get("SHUTDOWN_TIMEOUT", 25))
+    )
+
+async def main():
+    # Configure logging: records are formatted and written by a background
+    # thread, and per-join events are sampled and rate limited
+    listener = setup_logging(
+        level=os.environ.get("LOG_LEVEL", "INFO"),
+        fmt=os.environ.get("LOG_FORMAT", "json"),
+        sample=parse_rates(os.environ.get("LOG_SAMPLE", "join_approved=0.01")),
+        rate_limit=parse_rates(os.environ.get("LOG_RATE_LIMIT", "*=50")),
+        queue_size=int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+    )
+    try:
+        # Clients and asyncio primitives are created inside the running loop
+        application = create_app()
+        await application.run()
+    finally:
+        # Write out whatever is still queued
+        listener.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,464 @@
+import asyncio
+import logging
+import random
+import time
+
+from pyrogram.errors import (
+    FloodWait,
+    InternalServerError,
+    InputUserDeactivated,
+    MessageNotModified,
+    UserIsBlocked,
+    PeerIdInvalid,
+    ChatWriteForbidden
+)
+
+from metrics import FLOOD_WAIT_SECONDS, FLOOD_WAITS, SENDS
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows bots roughly 30 messages per second overall, one message
+# per second to a private chat and 20 messages per minute to a group.
+GLOBAL_RATE = 25.0
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+
+# Errors that mean the recipient can no longer be reached
+UNREACHABLE_ERRORS = (UserIsBlocked, PeerIdInvalid, InputUserDeactivated, ChatWriteForbidden)
+
+# Errors worth retrying: Telegram-side 5xx and dropped connections
+TRANSIENT_ERRORS = (InternalServerError, OSError, asyncio.TimeoutError)
+
+
+class PeerUnresolved(Exception):
+    """
+    The sending bot's session has no access hash for a chat and Telegram
+    would not resolve it by ID; says nothing about whether the chat can
+    still be reached, unlike PeerIdInvalid from a send
+    """
+
+
+def unreachable_reason(error: Exception):
+    """
+    Short reason stored on a recipient that can no longer be reached
+    """
+    if isinstance(error, UserIsBlocked):
+        return 'blocked'
+    if isinstance(error, InputUserDeactivated):
+        return 'deactivated'
+    if isinstance(error, ChatWriteForbidden):
+        return 'forbidden'
+    return 'invalid'
+
+
+# Final outcomes of a recipient
+DELIVERED = 'delivered'
+UNREACHABLE = 'unreachable'
+FAILED = 'failed'
+DROPPED = 'dropped'
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Token bucket shared by everything sending through one bot token
+
+        :param rate: Tokens added per second
+        :param capacity: Largest burst allowed, defaults to one second's worth
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for the given duration, e.g. after a FloodWait
+
+        :param seconds: How long every acquirer should wait
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def paused(self):
+        return time.monotonic() < self._paused_until
+
+    async def acquire(self):
+        """
+        Wait until a token is available and take it
+        """
+        # Waiters queue on the lock, so tokens are handed out in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PerChatLimiter:
+    def __init__(self, interval: float):
+        """
+        Enforce a minimum gap between sends to the same chat
+
+        :param interval: Seconds between two sends to one chat
+        """
+        self.interval = interval
+        self._last_sent = {}
+
+    async def acquire(self, chat_id: int):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            wait = last + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        self._last_sent[chat_id] = time.monotonic()
+
+        # Forget chats whose gap has already elapsed so the map stays small
+        if len(self._last_sent) > 10000:
+            cutoff = time.monotonic() - self.interval
+            self._last_sent = {k: v for k, v in self._last_sent.items() if v > cutoff}
+
+
+class BroadcastStats:
+    def __init__(self, total: int = None):
+        """
+        Counters for a single broadcast run
+
+        :param total: Number of recipients, if known up front
+        """
+        self.total = total
+        self.delivered = 0
+        self.unreachable = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.flood_waits = 0
+        self.started = time.monotonic()
+        self.finished = None
+        # Outcomes counted before this process picked the run up
+        self._resumed_delivered = 0
+        self._resumed_processed = 0
+
+    COUNTERS = ('delivered', 'unreachable', 'failed', 'dropped', 'retried', 'flood_waits')
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.COUNTERS}
+
+    @classmethod
+    def from_dict(cls, counters: dict, total: int = None):
+        """
+        Continue counting from a saved snapshot
+
+        :param counters: Output of to_dict()
+        :param total: Number of recipients, if known up front
+        """
+        stats = cls(total)
+        for name in cls.COUNTERS:
+            setattr(stats, name, (counters or {}).get(name, 0))
+        stats._resumed_delivered = stats.delivered
+        stats._resumed_processed = stats.processed
+        return stats
+
+    @property
+    def processed(self):
+        """Recipients with a final outcome"""
+        return self.delivered + self.unreachable + self.failed + self.dropped
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        """Achieved deliveries per second"""
+        delivered = self.delivered - self._resumed_delivered
+        return delivered / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def throughput(self):
+        """Recipients settled per second, whatever the outcome"""
+        processed = self.processed - self._resumed_processed
+        return processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Estimated seconds left, or None while there is nothing to go by"""
+        if not self.total or not self.throughput:
+            return None
+        return max(self.total - self.processed, 0) / self.throughput
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0, deadline: float = None):
+        """
+        Decide whether and when a failed send is attempted again
+
+        :param max_attempts: Attempts per recipient, including the first
+        :param base_delay: Backoff before the first retry of a transient error
+        :param max_delay: Upper bound for a single backoff
+        :param deadline: Seconds after the run starts past which nothing is retried
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def next_delay(self, attempt: int, error: Exception, started: float):
+        """
+        Return the delay before the next attempt, or None to give up
+
+        :param attempt: Number of the attempt that just failed
+        :param error: The exception it raised
+        :param started: Monotonic start time of the run
+        """
+        if attempt >= self.max_attempts:
+            return None
+
+        if isinstance(error, FloodWait):
+            # The bucket is already paused for e.value; only the deadline matters
+            delay = float(error.value)
+        else:
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+        if self.deadline is not None and time.monotonic() + delay > started + self.deadline:
+            return None
+        return delay
+
+
+class BroadcastEngine:
+    def __init__(self, buckets, workers: int = 20, retry_policy: RetryPolicy = None,
+                 buffer_size: int = 10000):
+        """
+        Deliver a message to many chats with bounded pools of workers
+
+        Each bucket is one lane: the send budget of one bot token with its
+        own worker pool. All runs on one engine share the lanes, so
+        concurrent broadcasts still respect each token's global limit and a
+        FloodWait pauses every sender on that token. FloodWaits and transient
+        network errors are requeued according to the retry policy instead of
+        being dropped.
+
+        :param buckets: Rate limiter per bot token, or a single TokenBucket
+        :param workers: Number of concurrent senders per lane and broadcast
+        :param retry_policy: When to retry a failed send
+        :param buffer_size: Recipients read ahead of the senders; bounds memory
+            even while one lane is paused
+        """
+        self.buckets = [buckets] if isinstance(buckets, TokenBucket) else list(buckets)
+        self.workers = workers
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.buffer_size = buffer_size
+
+    @property
+    def bucket(self):
+        """Bucket of the first lane"""
+        return self.buckets[0]
+
+    async def run(self, recipients, send, chat_interval: float = PRIVATE_CHAT_INTERVAL,
+                  total: int = None, on_progress=None, progress_interval: float = 5.0,
+                  on_result=None, stats: BroadcastStats = None, stop: asyncio.Event = None,
+                  route=None):
+        """
+        Send to every recipient and return the run's BroadcastStats
+
+        :param recipients: Iterable or async iterable of recipients
+        :param send: Coroutine function sending the message to one chat ID,
+            or a list with one such function per lane
+        :param chat_interval: Minimum seconds between sends to the same chat
+        :param total: Number of recipients, for progress reporting
+        :param on_progress: Coroutine function called with the stats from a
+            background task, so a slow or rate limited progress edit never
+            holds up the senders
+        :param progress_interval: Seconds between on_progress calls
+        :param on_result: Function called with (chat_id, outcome, error) once
+            a recipient is settled as delivered, unreachable, failed or
+            dropped; error is the last exception raised, if any
+        :param stats: Counters to continue from, e.g. when resuming a job
+        :param stop: Event that ends the run early; recipients not yet sent
+            to are left unsettled and never reported to on_result
+        :param route: Function mapping a recipient to (chat_id, lane); by
+            default recipients are chat IDs spread over the lanes by hash
+        """
+        if total is None and hasattr(recipients, '__len__'):
+            total = len(recipients)
+        if stats is None:
+            stats = BroadcastStats(total)
+        stop = stop or asyncio.Event()
+        lanes = len(self.buckets)
+        senders = list(send) if isinstance(send, (list, tuple)) else [send] * lanes
+        route = route or (lambda chat_id: (chat_id, hash(chat_id) % lanes))
+
+        # Lane queues hold (chat_id, attempt) pairs. They are unbounded so a
+        # paused lane never blocks the others; the semaphore bounds how many
+        # fresh recipients are buffered across all lanes instead.
+        queues = [asyncio.Queue() for _ in range(lanes)]
+        buffered = asyncio.Semaphore(self.buffer_size)
+        # Shared by every worker, so the gap holds whichever one sends
+        chat_limiter = PerChatLimiter(chat_interval)
+
+        # Recipients handed to a lane that have not been settled or abandoned
+        outstanding = 0
+        produced_all = False
+        drained = asyncio.Event()
+        retry_tasks = set()
+
+        def settle():
+            nonlocal outstanding
+            outstanding -= 1
+            if produced_all and outstanding == 0:
+                drained.set()
+
+        async def requeue_later(lane, item, delay):
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                queues[lane].put_nowait(item)
+            else:
+                # Stopped while waiting: leave it for a later run
+                settle()
+
+        async def iterate():
+            if hasattr(recipients, '__aiter__'):
+                async for recipient in recipients:
+                    yield recipient
+            else:
+                for recipient in recipients:
+                    yield recipient
+
+        async def produce():
+            nonlocal outstanding, produced_all
+            async for recipient in iterate():
+                if stop.is_set():
+                    break
+                chat_id, lane = route(recipient)
+                await buffered.acquire()
+                outstanding += 1
+                queues[lane].put_nowait((chat_id, 1))
+
+            produced_all = True
+            if outstanding == 0:
+                drained.set()
+            # Retries keep arriving until every recipient is settled
+            await drained.wait()
+            for queue in queues:
+                for _ in range(self.workers):
+                    queue.put_nowait(None)
+
+        async def work(lane):
+            queue = queues[lane]
+            bucket = self.buckets[lane]
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                chat_id, attempt = item
+                if attempt == 1:
+                    buffered.release()
+                if stop.is_set():
+                    settle()
+                    continue
+                await chat_limiter.acquire(chat_id)
+                await bucket.acquire()
+
+                outcome, delay, error = await self._deliver(chat_id, attempt, senders[lane], bucket, stats)
+                if outcome is None:
+                    stats.retried += 1
+                    task = asyncio.create_task(requeue_later(lane, (chat_id, attempt + 1), delay))
+                    retry_tasks.add(task)
+                    task.add_done_callback(retry_tasks.discard)
+                    continue
+                settle()
+                SENDS.inc(kind='broadcast', outcome=outcome)
+                if on_result:
+                    on_result(chat_id, outcome, error)
+
+        async def report():
+            # Samples the shared counters; the workers never wait on it
+            delay = progress_interval
+            while True:
+                await asyncio.sleep(delay)
+                delay = progress_interval
+                try:
+                    await on_progress(stats)
+                except MessageNotModified:
+                    pass
+                except FloodWait as e:
+                    # Edits have their own limits; back off without touching the send budget
+                    logger.warning(f"Progress update rate limited for {e.value} seconds")
+                    delay = max(progress_interval, e.value)
+                except Exception as e:
+                    logger.warning(f"Progress update failed: {e}")
+
+        workers = [
+            asyncio.create_task(work(lane))
+            for lane in range(lanes)
+            for _ in range(self.workers)
+        ]
+        reporter = asyncio.create_task(report()) if on_progress else None
+        try:
+            await asyncio.gather(produce(), *workers)
+        finally:
+            for task in workers + list(retry_tasks):
+                task.cancel()
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+            stats.finished = time.monotonic()
+        return stats
+
+    async def _deliver(self, chat_id: int, attempt: int, send, bucket: TokenBucket, stats: BroadcastStats):
+        """
+        Attempt one send and count its outcome
+
+        :return: (outcome, None, error) once settled, or (None, delay, error) to retry
+        """
+        try:
+            await send(chat_id)
+            stats.delivered += 1
+            return DELIVERED, None, None
+        except FloodWait as e:
+            # Hold back every sender on this token, not just this coroutine
+            logger.warning(f"Flood wait for {e.value} seconds, pausing broadcast",
+                           extra={'event': 'flood_wait', 'chat_id': chat_id, 'wait': e.value})
+            bucket.pause(e.value)
+            stats.flood_waits += 1
+            FLOOD_WAITS.inc(source='broadcast')
+            FLOOD_WAIT_SECONDS.inc(e.value, source='broadcast')
+            error = e
+        except PeerUnresolved as e:
+            # Skipped without flagging the recipient; a session that knows
+            # the peer reaches it on the next broadcast
+            stats.failed += 1
+            logger.warning(f"Skipping {chat_id}, peer not known to this session",
+                           extra={'event': 'peer_unresolved', 'chat_id': chat_id})
+            return FAILED, None, e
+        except UNREACHABLE_ERRORS as e:
+            stats.unreachable += 1
+            return UNREACHABLE, None, e
+        except TRANSIENT_ERRORS as e:
+            error = e
+        except Exception as e:
+            stats.failed += 1
+            logger.error(f"Error broadcasting to {chat_id}: {e}",
+                         extra={'event': 'broadcast_error', 'chat_id': chat_id})
+            return FAILED, None, e
+
+        delay = self.retry_policy.next_delay(attempt, error, stats.started)
+        if delay is None:
+            stats.dropped += 1
+            logger.warning(f"Giving up on {chat_id} after {attempt} attempts: {error}",
+                           extra={'event': 'broadcast_dropped', 'chat_id': chat_id, 'attempts': attempt})
+            return DROPPED, None, error
+        return None, delay, error
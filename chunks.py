@@ -0,0 +1,157 @@
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Chunk statuses
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+class ChunkQueue:
+    def __init__(self, db: Database, lease_seconds: float = 60.0):
+        """
+        Broadcast recipients split into chunks that processes claim from
+        MongoDB
+
+        A claim is a single find_one_and_update, so two processes never
+        get the same chunk. The claim comes with a lease that its holder
+        renews while it works; a chunk whose lease ran out, because its
+        process died or hung, is handed to the next process that asks.
+        Lease times come from each process's clock, so hosts need to be
+        roughly in sync.
+
+        :param db: Database holding the broadcast_chunks collection
+        :param lease_seconds: How long a claim holds without renewal
+        """
+        self.db = db
+        self.lease_seconds = lease_seconds
+
+    @property
+    def collection(self):
+        return self.db.broadcast_chunks_collection
+
+    def _lease_until(self):
+        return datetime.now() + timedelta(seconds=self.lease_seconds)
+
+    async def split(self, job_id, recipients, chunk_size: int, dedupe: bool = False):
+        """
+        Stream recipients into chunks; each chunk can be claimed as soon
+        as it is written
+
+        :param job_id: Job the recipients belong to
+        :param recipients: Async iterator of (chat_id, bots) pairs
+        :param chunk_size: Recipients per chunk
+        :param dedupe: Have whoever sends a chunk skip recipients that
+            already have a checkpoint, even on its first claim
+        :return: (number of chunks, number of recipients)
+        """
+        last = await self.collection.find_one({'job_id': job_id}, {'seq': 1}, sort=[('seq', -1)])
+        seq = last['seq'] + 1 if last else 0
+        chunks = 0
+        count = 0
+        batch = []
+
+        async def write(batch):
+            await self.collection.insert_one({
+                'job_id': job_id,
+                'seq': seq + chunks,
+                'status': PENDING,
+                'recipients': [[chat_id, list(bots)] for chat_id, bots in batch],
+                'attempts': 0,
+                'dedupe': dedupe,
+                'created_at': datetime.now()
+            })
+
+        async for recipient in recipients:
+            batch.append(recipient)
+            if len(batch) >= chunk_size:
+                await write(batch)
+                chunks += 1
+                count += len(batch)
+                batch = []
+        if batch:
+            await write(batch)
+            chunks += 1
+            count += len(batch)
+        return chunks, count
+
+    async def discard(self, job_id):
+        """
+        Drop every chunk of a job, e.g. once it is cancelled or before an
+        interrupted split is redone; processes holding one of them lose
+        their lease and stop at the next renewal
+        """
+        await self.collection.delete_many({'job_id': job_id})
+
+    async def claim(self, owner: str, job_ids):
+        """
+        Lease the next pending or expired chunk of the given jobs
+
+        :param owner: Name of the claiming process
+        :param job_ids: Jobs whose chunks may be claimed
+        :return: The chunk document, or None if there is nothing to do
+        """
+        now = datetime.now()
+        return await self.collection.find_one_and_update(
+            {
+                'job_id': {'$in': list(job_ids)},
+                '$or': [
+                    {'status': PENDING},
+                    {'status': LEASED, 'lease_until': {'$lt': now}},
+                ]
+            },
+            {
+                '$set': {'status': LEASED, 'owner': owner, 'lease_until': self._lease_until()},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('seq', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def renew(self, chunk_id, owner: str):
+        """
+        Extend a lease
+
+        :return: False if the lease was lost to another process
+        """
+        result = await self.collection.update_one(
+            {'_id': chunk_id, 'status': LEASED, 'owner': owner},
+            {'$set': {'lease_until': self._lease_until()}}
+        )
+        return result.modified_count > 0
+
+    async def complete(self, chunk_id, owner: str):
+        """
+        Mark a leased chunk done, dropping its recipient list
+        """
+        await self.collection.update_one(
+            {'_id': chunk_id, 'status': LEASED, 'owner': owner},
+            {'$set': {'status': DONE, 'done_at': datetime.now()}, '$unset': {'recipients': ''}}
+        )
+
+    async def release(self, chunk_id, owner: str):
+        """
+        Give a leased chunk back unfinished so any process can take it
+        """
+        await self.collection.update_one(
+            {'_id': chunk_id, 'status': LEASED, 'owner': owner},
+            {'$set': {'status': PENDING}, '$unset': {'owner': '', 'lease_until': ''}}
+        )
+
+    async def progress(self, job_id):
+        """
+        Count a job's chunks by status
+
+        :return: Mapping of status to number of chunks
+        """
+        cursor = await self.collection.aggregate([
+            {'$match': {'job_id': job_id}},
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ])
+        return {group['_id']: group['count'] async for group in cursor}
@@ -0,0 +1,562 @@
+import logging
+import random
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+from metrics import MongoLatencyListener
+
+logger = logging.getLogger(__name__)
+
+# How long per-recipient broadcast checkpoints are kept
+DELIVERY_RETENTION_SECONDS = 30 * 24 * 3600
+
+# Recipients flagged unreachable are left out of broadcasts. Every upsert
+# writes blocked: False, so this is an equality on the leading field of the
+# (blocked, rand) index and recipients come back in shuffle-key order
+REACHABLE = {'blocked': False}
+
+
+def seen_by(update: dict, bot_id: int = None):
+    """
+    Record on an upsert document that a bot can reach the user or chat
+
+    :param update: Update document to extend
+    :param bot_id: ID of the bot that saw it; None leaves update unchanged
+    """
+    if bot_id is not None:
+        # $each so coalesced updates from several bots merge into one list
+        update['$addToSet'] = {'bots': {'$each': [bot_id]}}
+    return update
+
+
+def user_update(username: str, bot_id: int = None):
+    """
+    Build the upsert document for a user
+
+    :param username: Telegram username
+    :param bot_id: ID of the bot the user interacted with
+    """
+    return seen_by({
+        '$set': {
+            'username': username,
+            'last_seen': datetime.now(),
+            # The user just interacted with the bot, so it can reach them again
+            'blocked': False
+        },
+        '$unset': {'blocked_at': '', 'blocked_reason': ''},
+        # Stored shuffle key, see Database.iter_user_ids
+        '$setOnInsert': {'rand': random.random()}
+    }, bot_id)
+
+
+def chat_update(name: str, added_by: int = None, bot_id: int = None):
+    """
+    Build the upsert document for a channel or group
+
+    :param name: Title of the chat
+    :param added_by: ID of the user who added the chat; None when the chat
+        is only seen through a join request, which leaves added_by and
+        added_date as they are
+    :param bot_id: ID of the bot that is a member of the chat
+    """
+    fields = {'name': name, 'blocked': False}
+    if added_by is not None:
+        fields.update(added_by=added_by, added_date=datetime.now())
+    return seen_by({
+        '$set': fields,
+        '$unset': {'blocked_at': '', 'blocked_reason': ''},
+        '$setOnInsert': {'rand': random.random()}
+    }, bot_id)
+
+
+def membership_update():
+    """
+    Build the upsert document recording that a user joined a chat
+    """
+    now = datetime.now()
+    return {
+        '$set': {'last_joined': now},
+        '$setOnInsert': {'first_joined': now}
+    }
+
+
+def unreachable_update(reason: str):
+    """
+    Build the update flagging a user or group the bot can no longer reach
+
+    :param reason: Why sends fail, e.g. 'blocked' or 'deactivated'
+    """
+    return {'$set': {
+        'blocked': True,
+        'blocked_reason': reason,
+        'blocked_at': datetime.now()
+    }}
+
+
+def reachable_update():
+    """
+    Build the update clearing an unreachable flag; MongoDB applies it as a
+    no-op, without writing, to documents that carry no flag
+    """
+    return {'$set': {'blocked': False}, '$unset': {'blocked_at': '', 'blocked_reason': ''}}
+
+
+class Database:
+    def __init__(self, mongo_uri, db_name: str = "ApproveBot", blocked_retention_days: float = None):
+        """
+        Initialize the async MongoDB database handles.
+
+        The client connects lazily, so constructing it never blocks; call
+        connect() from inside the running event loop before serving updates.
+
+        :param mongo_uri: MongoDB connection string
+        :param db_name: Name of the database to use
+        :param blocked_retention_days: Delete users flagged unreachable this
+            many days after the flag was set; None keeps them
+        """
+        self.logger = logger
+        self.blocked_retention_days = blocked_retention_days
+
+        # The async client binds to the running loop on first use; the
+        # listener times every command for the metrics endpoint
+        self.client = AsyncMongoClient(mongo_uri, event_listeners=[MongoLatencyListener()])
+
+        # Select the database
+        self.db = self.client[db_name]
+
+        # Define collections
+        self.users_collection = self.db.users
+        self.channels_collection = self.db.channels
+        self.groups_collection = self.db.groups
+        # One document per (user, chat) the user joined through the bot
+        self.memberships_collection = self.db.memberships
+        self.broadcast_jobs_collection = self.db.broadcast_jobs
+        self.broadcast_deliveries_collection = self.db.broadcast_deliveries
+        self.broadcast_chunks_collection = self.db.broadcast_chunks
+        self.media_cache_collection = self.db.media_cache
+        self.templates_collection = self.db.templates
+        # Rollups kept up to date by the write-behind buffer, see stats.py
+        self.daily_stats_collection = self.db.daily_stats
+        self.chat_stats_collection = self.db.chat_stats
+
+    async def connect(self):
+        """
+        Open the connection pool and verify the server is reachable
+        """
+        try:
+            await self.client.admin.command('ping')
+            self.logger.info("Successfully connected to MongoDB")
+        except ConnectionFailure:
+            self.logger.error("Failed to connect to MongoDB. Check your connection string.")
+            raise
+        except Exception as e:
+            self.logger.error(f"An error occurred while setting up MongoDB: {e}")
+            raise
+
+    async def ensure_schema(self):
+        """
+        Bootstrap indexes, deduplicating first where a unique index is new;
+        safe to run on every startup
+        """
+        for collection, key_field, newest_field in (
+            (self.users_collection, 'user_id', 'last_seen'),
+            (self.channels_collection, 'chat_id', 'added_date'),
+            (self.groups_collection, 'chat_id', 'added_date'),
+        ):
+            # Once the unique index exists there can be no new duplicates
+            if not await self._has_unique_index(collection, key_field):
+                await self.dedupe(collection, key_field, newest_field)
+        await self.ensure_indexes()
+
+    async def _has_unique_index(self, collection, key_field: str):
+        indexes = await collection.index_information()
+        return any(
+            index.get('unique') and index['key'] == [(key_field, ASCENDING)]
+            for index in indexes.values()
+        )
+
+    async def dedupe(self, collection, key_field: str, newest_field: str, batch_size: int = 1000):
+        """
+        Delete duplicate documents left by unindexed concurrent upserts,
+        keeping the most recently written one per key
+
+        :param collection: Collection to clean up
+        :param key_field: Field that should be unique
+        :param newest_field: Timestamp field deciding which copy survives
+        :return: Number of documents removed
+        """
+        pipeline = [
+            {'$sort': {key_field: ASCENDING, newest_field: -1}},
+            {'$group': {'_id': f'${key_field}', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ]
+        removed = 0
+        extra_ids = []
+        cursor = await collection.aggregate(pipeline, allowDiskUse=True)
+        async for group in cursor:
+            # The first ID is the newest copy
+            extra_ids.extend(group['ids'][1:])
+            if len(extra_ids) >= batch_size:
+                removed += (await collection.delete_many({'_id': {'$in': extra_ids}})).deleted_count
+                extra_ids = []
+        if extra_ids:
+            removed += (await collection.delete_many({'_id': {'$in': extra_ids}})).deleted_count
+
+        if removed:
+            self.logger.warning(f"Removed {removed} duplicate documents from {collection.name}")
+        return removed
+
+    async def ensure_indexes(self):
+        """
+        Create the indexes the bot relies on; safe to run on every startup
+        """
+        # Upserts look documents up by these keys; unique also stops
+        # concurrent upserts from inserting the same user or chat twice
+        await self.users_collection.create_index([('user_id', ASCENDING)], unique=True)
+        await self.channels_collection.create_index([('chat_id', ASCENDING)], unique=True)
+        await self.groups_collection.create_index([('chat_id', ASCENDING)], unique=True)
+
+        # Recipient iteration in shuffle-key order, skipping unreachable
+        # recipients, and activity queries
+        for collection in (self.users_collection, self.groups_collection):
+            await collection.create_index([('rand', ASCENDING)])
+            await collection.create_index([('blocked', ASCENDING), ('rand', ASCENDING)])
+        await self.users_collection.create_index([('last_seen', ASCENDING)])
+        await self._ensure_blocked_ttl()
+
+        # Memberships: one per user and chat, and segment queries by chat
+        # and join date
+        await self.memberships_collection.create_index(
+            [('user_id', ASCENDING), ('chat_id', ASCENDING)],
+            unique=True
+        )
+        await self.memberships_collection.create_index([('chat_id', ASCENDING), ('last_joined', ASCENDING)])
+
+        # Broadcast jobs: resume lookup, and one checkpoint per recipient
+        await self.broadcast_jobs_collection.create_index([('status', ASCENDING)])
+        await self.broadcast_deliveries_collection.create_index(
+            [('job_id', ASCENDING), ('chat_id', ASCENDING)],
+            unique=True
+        )
+        await self.broadcast_deliveries_collection.create_index(
+            [('at', ASCENDING)],
+            expireAfterSeconds=DELIVERY_RETENTION_SECONDS
+        )
+
+        # Chunked broadcasts: claims by job, status and order
+        await self.broadcast_chunks_collection.create_index(
+            [('job_id', ASCENDING), ('seq', ASCENDING)],
+            unique=True
+        )
+        await self.broadcast_chunks_collection.create_index(
+            [('job_id', ASCENDING), ('status', ASCENDING), ('seq', ASCENDING)]
+        )
+
+        # Stats rollups: one per day and per chat, busiest chats first
+        await self.daily_stats_collection.create_index([('day', ASCENDING)], unique=True)
+        await self.chat_stats_collection.create_index([('chat_id', ASCENDING)], unique=True)
+        await self.chat_stats_collection.create_index([('joins', DESCENDING)])
+
+        # Welcome templates: one per kind and chat, and the change check
+        await self.templates_collection.create_index(
+            [('kind', ASCENDING), ('chat_id', ASCENDING)],
+            unique=True
+        )
+        await self.templates_collection.create_index([('updated_at', ASCENDING)])
+
+        # Uploaded media, one file_id per bot and source URL
+        await self.media_cache_collection.create_index(
+            [('bot_id', ASCENDING), ('url', ASCENDING)],
+            unique=True
+        )
+
+    async def backfill_fields(self):
+        """
+        Give documents written before the shuffle key existed a random one,
+        and those written before the blocked flag existed blocked: False
+        """
+        for collection in (self.users_collection, self.channels_collection, self.groups_collection):
+            try:
+                result = await collection.update_many(
+                    {'rand': {'$exists': False}},
+                    [{'$set': {'rand': {'$rand': {}}}}]
+                )
+                if result.modified_count:
+                    self.logger.info(f"Assigned shuffle keys to {result.modified_count} documents in {collection.name}")
+                result = await collection.update_many(
+                    {'blocked': {'$exists': False}},
+                    {'$set': {'blocked': False}}
+                )
+                if result.modified_count:
+                    self.logger.info(f"Marked {result.modified_count} documents in {collection.name} reachable")
+            except PyMongoError as e:
+                self.logger.error(f"Error backfilling fields in {collection.name}: {e}")
+
+    async def _ensure_blocked_ttl(self):
+        """
+        Apply the optional retention policy for unreachable users as a TTL
+        index on blocked_at, keeping an existing index in sync with it
+        """
+        name = 'blocked_at_ttl'
+        indexes = await self.users_collection.index_information()
+
+        if self.blocked_retention_days is None:
+            if name in indexes:
+                await self.users_collection.drop_index(name)
+            return
+
+        seconds = int(self.blocked_retention_days * 24 * 3600)
+        if name not in indexes:
+            await self.users_collection.create_index(
+                [('blocked_at', ASCENDING)],
+                name=name,
+                expireAfterSeconds=seconds,
+                partialFilterExpression={'blocked': True}
+            )
+        elif indexes[name].get('expireAfterSeconds') != seconds:
+            await self.db.command({
+                'collMod': self.users_collection.name,
+                'index': {'name': name, 'expireAfterSeconds': seconds}
+            })
+
+    async def add_user(self, user_id: int, username: str, bot_id: int = None):
+        """
+        Add a new user or update existing user in the database
+
+        :param user_id: Telegram user ID
+        :param username: Telegram username
+        :param bot_id: ID of the bot the user interacted with
+        """
+        try:
+            # Upsert operation: insert if not exists, update if exists
+            await self.users_collection.update_one(
+                {'user_id': user_id},
+                user_update(username, bot_id),
+                upsert=True
+            )
+            self.logger.debug(f"User {user_id} added/updated successfully")
+        except PyMongoError as e:
+            self.logger.error(f"Error adding user {user_id}: {e}")
+
+    async def add_channel(self, user_id: int, channel_name: str, chat_id: int, bot_id: int = None):
+        """
+        Add a channel to the database
+
+        :param user_id: ID of user who added the channel; None leaves the
+            recorded one unchanged
+        :param channel_name: Name of the channel
+        :param chat_id: Telegram chat ID of the channel
+        :param bot_id: ID of the bot added to the channel
+        """
+        try:
+            # Upsert operation for channels
+            await self.channels_collection.update_one(
+                {'chat_id': chat_id},
+                chat_update(channel_name, user_id, bot_id),
+                upsert=True
+            )
+            self.logger.debug(f"Channel {channel_name} added successfully")
+        except PyMongoError as e:
+            self.logger.error(f"Error adding channel {channel_name}: {e}")
+
+    async def add_group(self, user_id: int, group_name: str, group_id: int, bot_id: int = None):
+        """
+        Add a group to the database
+
+        :param user_id: ID of user who added the group; None leaves the
+            recorded one unchanged
+        :param group_name: Name of the group
+        :param group_id: Telegram chat ID of the group
+        :param bot_id: ID of the bot added to the group
+        """
+        try:
+            # Upsert operation for groups
+            await self.groups_collection.update_one(
+                {'chat_id': group_id},
+                chat_update(group_name, user_id, bot_id),
+                upsert=True
+            )
+            self.logger.debug(f"Group {group_name} added successfully")
+        except PyMongoError as e:
+            self.logger.error(f"Error adding group {group_name}: {e}")
+
+    async def add_membership(self, user_id: int, chat_id: int):
+        """
+        Record that a user joined a channel or group
+
+        :param user_id: Telegram user ID
+        :param chat_id: Telegram chat ID of the channel or group
+        """
+        try:
+            await self.memberships_collection.update_one(
+                {'user_id': user_id, 'chat_id': chat_id},
+                membership_update(),
+                upsert=True
+            )
+        except PyMongoError as e:
+            self.logger.error(f"Error adding membership of {user_id} in {chat_id}: {e}")
+
+    async def bulk_upsert(self, collection, key_field, updates: dict, upsert: bool = True):
+        """
+        Apply many upserts to one collection in a single round trip
+
+        :param collection: Collection to write to
+        :param key_field: Field the documents are keyed on, or a tuple of
+            fields for compound keys
+        :param updates: Mapping of key value (a tuple for compound keys) to
+            update document
+        :param upsert: Insert documents that do not exist yet
+        :return: The BulkWriteResult
+        """
+        def key_filter(key):
+            if isinstance(key_field, tuple):
+                return dict(zip(key_field, key))
+            return {key_field: key}
+
+        ops = [
+            UpdateOne(key_filter(key), update, upsert=upsert)
+            for key, update in updates.items()
+        ]
+        # Unordered so one bad document does not hold back the rest
+        return await collection.bulk_write(ops, ordered=False)
+
+    async def _iter_ids(self, collection, key_field: str, batch_size: int, with_bots: bool = False):
+        """
+        Stream one field of every reachable document in a random order
+
+        Starts at a random point of the indexed shuffle key and wraps around,
+        so each run sees a different order without loading or shuffling the
+        whole collection in memory.
+        """
+        pivot = random.random()
+        ranges = (
+            {'rand': {'$gte': pivot}},
+            {'rand': {'$lt': pivot}},
+            # Documents not yet backfilled with a shuffle key
+            {'rand': None},
+        )
+        projection = {key_field: 1, '_id': 0}
+        if with_bots:
+            projection['bots'] = 1
+        for query in ranges:
+            cursor = collection.find(
+                {**query, **REACHABLE},
+                projection
+            ).sort('rand', ASCENDING).batch_size(batch_size)
+            async for document in cursor:
+                if with_bots:
+                    yield document[key_field], document.get('bots') or ()
+                else:
+                    yield document[key_field]
+
+    def iter_user_ids(self, batch_size: int = 1000, with_bots: bool = False):
+        """
+        Stream all user IDs in a random order with flat memory use
+
+        :param batch_size: Documents fetched per cursor round trip
+        :param with_bots: Yield (user_id, IDs of the bots that can reach
+            the user) pairs instead of bare IDs
+        :return: Async iterator of user IDs
+        """
+        return self._iter_ids(self.users_collection, 'user_id', batch_size, with_bots)
+
+    def iter_group_ids(self, batch_size: int = 1000, with_bots: bool = False):
+        """
+        Stream all group chat IDs in a random order with flat memory use
+
+        :param batch_size: Documents fetched per cursor round trip
+        :param with_bots: Yield (chat_id, IDs of the bots in the group)
+            pairs instead of bare IDs
+        :return: Async iterator of group chat IDs
+        """
+        return self._iter_ids(self.groups_collection, 'chat_id', batch_size, with_bots)
+
+    def _members_query(self, chat_id: int, since: datetime = None):
+        query = {'chat_id': chat_id}
+        if since is not None:
+            query['last_joined'] = {'$gte': since}
+        return query
+
+    async def iter_member_ids(self, chat_id: int, since: datetime = None, batch_size: int = 1000,
+                              with_bots: bool = False):
+        """
+        Stream the reachable users who joined a chat, optionally only
+        those who joined since a given time
+
+        Walks the (chat_id, last_joined) index and looks each batch up in
+        users, so only matching recipients are ever read.
+
+        :param chat_id: Telegram chat ID of the channel or group
+        :param since: Only users whose latest join is this recent
+        :param batch_size: Documents fetched per cursor round trip
+        :param with_bots: Yield (user_id, IDs of the bots that can reach
+            the user) pairs instead of bare IDs
+        :return: Async iterator of user IDs
+        """
+        cursor = self.memberships_collection.find(
+            self._members_query(chat_id, since),
+            {'user_id': 1, '_id': 0}
+        ).batch_size(batch_size)
+
+        async def reachable(batch):
+            users = self.users_collection.find(
+                {'user_id': {'$in': batch}, **REACHABLE},
+                {'user_id': 1, 'bots': 1, '_id': 0}
+            )
+            async for user in users:
+                yield (user['user_id'], user.get('bots') or ()) if with_bots else user['user_id']
+
+        batch = []
+        async for membership in cursor:
+            batch.append(membership['user_id'])
+            if len(batch) >= batch_size:
+                async for recipient in reachable(batch):
+                    yield recipient
+                batch = []
+        if batch:
+            async for recipient in reachable(batch):
+                yield recipient
+
+    async def count_members(self, chat_id: int, since: datetime = None):
+        """
+        Count the users who joined a chat, for progress reporting; users
+        flagged unreachable are included, so this is an upper bound
+        """
+        return await self.memberships_collection.count_documents(self._members_query(chat_id, since))
+
+    async def iter_chats(self):
+        """
+        Stream every known channel and group
+
+        :return: Async iterator of {'chat_id', 'name'} documents
+        """
+        for collection in (self.channels_collection, self.groups_collection):
+            async for chat in collection.find({}, {'chat_id': 1, 'name': 1, '_id': 0}):
+                yield chat
+
+    async def _count_reachable(self, collection):
+        # Metadata count minus the indexed count of flagged documents
+        total = await collection.estimated_document_count()
+        blocked = await collection.count_documents({'blocked': True})
+        return max(total - blocked, 0)
+
+    async def count_users(self):
+        """
+        Cheap count of reachable users, for progress reporting
+        """
+        return await self._count_reachable(self.users_collection)
+
+    async def count_groups(self):
+        """
+        Cheap count of reachable groups, for progress reporting
+        """
+        return await self._count_reachable(self.groups_collection)
+
+    async def close(self):
+        """
+        Close the MongoDB connection pool
+        """
+        await self.client.close()
+        self.logger.info("MongoDB connection closed")
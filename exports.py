@@ -0,0 +1,99 @@
+import asyncio
+import gzip
+import logging
+
+from bson import json_util
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Exportable collections: name -> (Database attribute, key field(s))
+COLLECTIONS = {
+    'users': ('users_collection', 'user_id'),
+    'channels': ('channels_collection', 'chat_id'),
+    'groups': ('groups_collection', 'chat_id'),
+    'memberships': ('memberships_collection', ('user_id', 'chat_id')),
+}
+
+
+async def export_collection(db: Database, name: str, path: str, batch_size: int = 1000):
+    """
+    Stream a collection into a gzip-compressed JSON lines file
+
+    Documents are read with a cursor and compressed batch by batch in a
+    thread, so memory stays flat and the event loop keeps serving updates.
+    Dates and other BSON types are written as extended JSON, which
+    import_collection reads back.
+
+    :param db: Database to export from
+    :param name: Key of COLLECTIONS
+    :param path: File to write
+    :param batch_size: Documents per cursor round trip and per write
+    :return: Number of documents exported
+    """
+    collection = getattr(db, COLLECTIONS[name][0])
+    file = await asyncio.to_thread(gzip.open, path, 'wt', encoding='utf-8')
+    count = 0
+    try:
+        lines = []
+        async for document in collection.find({}, {'_id': 0}).batch_size(batch_size):
+            lines.append(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS))
+            if len(lines) >= batch_size:
+                await asyncio.to_thread(file.write, '\n'.join(lines) + '\n')
+                count += len(lines)
+                lines = []
+        if lines:
+            await asyncio.to_thread(file.write, '\n'.join(lines) + '\n')
+            count += len(lines)
+    finally:
+        await asyncio.to_thread(file.close)
+    logger.info(f"Exported {count} documents from {name}")
+    return count
+
+
+def _read_batch(file, batch_size: int):
+    batch = []
+    for line in file:
+        if line.strip():
+            batch.append(json_util.loads(line))
+            if len(batch) >= batch_size:
+                break
+    return batch
+
+
+async def import_collection(db: Database, name: str, path: str, batch_size: int = 1000):
+    """
+    Upsert documents from a file written by export_collection
+
+    Documents are matched on the collection's key, so importing the same
+    file twice, or into a database that already has some of the
+    documents, updates them instead of duplicating them.
+
+    :param db: Database to import into
+    :param name: Key of COLLECTIONS
+    :param path: gzip-compressed JSON lines file
+    :param batch_size: Documents per bulk write
+    :return: Number of documents imported
+    """
+    attribute, key_field = COLLECTIONS[name]
+    collection = getattr(db, attribute)
+    fields = key_field if isinstance(key_field, tuple) else (key_field,)
+    file = await asyncio.to_thread(gzip.open, path, 'rt', encoding='utf-8')
+    count = 0
+    try:
+        while True:
+            batch = await asyncio.to_thread(_read_batch, file, batch_size)
+            if not batch:
+                break
+            updates = {}
+            for document in batch:
+                document.pop('_id', None)
+                key = tuple(document[field] for field in fields)
+                updates[key if isinstance(key_field, tuple) else key[0]] = {'$set': document}
+            await db.bulk_upsert(collection, key_field, updates)
+            count += len(batch)
+    finally:
+        await asyncio.to_thread(file.close)
+    logger.info(f"Imported {count} documents into {name}")
+    return count
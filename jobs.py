@@ -0,0 +1,689 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError
+from pyrogram.errors import FloodWait, MessageNotModified
+
+from broadcast import UNREACHABLE, BroadcastEngine, BroadcastStats, unreachable_reason
+from chunks import DONE, LEASED, ChunkQueue
+from database import Database
+from metrics import BROADCAST_PROCESSED, BROADCAST_TOTAL, BROADCASTS_RUNNING
+from shards import ShardSet
+
+logger = logging.getLogger(__name__)
+
+# Job statuses
+RUNNING = 'running'
+PAUSED = 'paused'
+CANCELLED = 'cancelled'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+
+def parse_job_id(text: str):
+    """
+    Turn a job ID typed by an admin into an ObjectId, or None if malformed
+    """
+    try:
+        return ObjectId(text.strip())
+    except (InvalidId, TypeError):
+        return None
+
+
+class BroadcastTarget:
+    def __init__(self, recipients, count, make_sender, chat_interval: float,
+                 title: str, unreachable_label: str, on_unreachable=None):
+        """
+        Describe who a kind of broadcast goes to and how it is sent
+
+        :param recipients: Function taking the job document and returning
+            an async iterator of (chat_id, IDs of the bots that can reach
+            it) pairs
+        :param count: Coroutine function taking the job document and
+            returning the expected number of recipients
+        :param make_sender: Function taking (client, source message,
+            source_client, bucket=client's send budget) and returning a
+            coroutine function that sends to one chat ID, normally
+            PreparedSend
+        :param chat_interval: Minimum seconds between sends to the same chat
+        :param title: Name shown in progress messages, e.g. "Group Broadcast"
+        :param unreachable_label: How unreachable recipients are reported
+        :param on_unreachable: Function called with (chat_id, reason) for
+            each recipient that turned out to be unreachable
+        """
+        self.recipients = recipients
+        self.count = count
+        self.make_sender = make_sender
+        self.chat_interval = chat_interval
+        self.title = title
+        self.unreachable_label = unreachable_label
+        self.on_unreachable = on_unreachable
+
+
+class DeliveryLog:
+    def __init__(self, db: Database, job_id, stats: BroadcastStats,
+                 batch_size: int = 500, interval: float = 5.0, increment: bool = False):
+        """
+        Checkpoint settled recipients and job counters in batches
+
+        :param db: Database holding the job collections
+        :param job_id: Job the deliveries belong to
+        :param stats: Live counters of the run, saved on every flush
+        :param batch_size: Settled recipients that trigger a flush
+        :param interval: Longest time between two flushes
+        :param increment: Add what the counters gained since the last flush
+            to the job's counters instead of overwriting them, for runs
+            that cover only part of the job
+        """
+        self.db = db
+        self.job_id = job_id
+        self.stats = stats
+        self.batch_size = batch_size
+        self.interval = interval
+        self.increment = increment
+        self._saved = stats.to_dict()
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    def record(self, chat_id: int, outcome: str, error: Exception = None):
+        self._pending.append({
+            'job_id': self.job_id,
+            'chat_id': chat_id,
+            'outcome': outcome,
+            'at': datetime.now()
+        })
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            try:
+                await self.db.broadcast_deliveries_collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Duplicates are recipients already checkpointed before a restart
+                errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+                if errors:
+                    logger.error(f"Failed to checkpoint {len(errors)} deliveries for job {self.job_id}")
+            except PyMongoError as e:
+                logger.error(f"Failed to checkpoint deliveries for job {self.job_id}, will retry: {e}")
+                self._pending = batch + self._pending
+                return
+
+        counters = self.stats.to_dict()
+        if self.increment:
+            update = {
+                '$inc': {f'stats.{name}': value - self._saved[name] for name, value in counters.items()},
+                '$set': {'updated_at': datetime.now()}
+            }
+        else:
+            update = {'$set': {'stats': counters, 'updated_at': datetime.now()}}
+        try:
+            await self.db.broadcast_jobs_collection.update_one({'_id': self.job_id}, update)
+            self._saved = counters
+        except PyMongoError as e:
+            logger.error(f"Failed to checkpoint counters for job {self.job_id}: {e}")
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        await self.flush()
+
+
+class BroadcastJobManager:
+    def __init__(self, db: Database, engine: BroadcastEngine, targets: dict, shards: ShardSet,
+                 checkpoint_batch: int = 500, checkpoint_interval: float = 5.0,
+                 progress_interval: float = 5.0, chunks: ChunkQueue = None,
+                 chunk_size: int = 5000, worker_name: str = 'bot', poll_interval: float = 2.0):
+        """
+        Run broadcasts as jobs persisted in MongoDB so they survive restarts
+
+        Each job document records the source message, status and counters;
+        every settled recipient is checkpointed in broadcast_deliveries, and
+        a resumed job skips recipients that already have a checkpoint.
+        Recipients are spread over the bots of the shard set, one engine
+        lane per bot; the bot that received the command stays in charge of
+        the job's source and progress messages.
+
+        With a chunk queue, new jobs are split into recipient chunks that
+        every process running a manager claims and sends, worker processes
+        included. The process that created the job only splits it and
+        keeps the admin's progress message updated from the job's
+        counters, which each chunk adds to as it goes.
+
+        :param db: Database holding the job collections
+        :param engine: Engine that performs the sends
+        :param targets: Mapping of target name to BroadcastTarget
+        :param shards: Bots to send through, in engine lane order
+        :param checkpoint_batch: Settled recipients per checkpoint write
+        :param checkpoint_interval: Longest time between checkpoint writes
+        :param progress_interval: Seconds between progress message edits
+        :param chunks: ChunkQueue to share new jobs through, or None to
+            send each job from the process that runs it
+        :param chunk_size: Recipients per chunk
+        :param worker_name: Name this process claims chunks under; must be
+            unique among processes
+        :param poll_interval: Seconds between claim attempts when idle
+        """
+        self.db = db
+        self.engine = engine
+        self.targets = targets
+        self.shards = shards
+        self.checkpoint_batch = checkpoint_batch
+        self.checkpoint_interval = checkpoint_interval
+        self.progress_interval = progress_interval
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.worker_name = worker_name
+        self.poll_interval = poll_interval
+
+        # job_id -> (task, stop event) for jobs running in this process
+        self._running = {}
+        # job_id -> status to record once a stopped job has wound down
+        self._stop_status = {}
+        # Chunk consumer, and the stop events of chunks being sent
+        self._consumer = None
+        self._consumer_stop = asyncio.Event()
+        self._chunk_stops = set()
+        # job_id -> senders built for its chunks in this process
+        self._chunk_senders = {}
+        BROADCASTS_RUNNING.set_function(lambda: len(self._running))
+
+    @property
+    def jobs(self):
+        return self.db.broadcast_jobs_collection
+
+    async def create(self, client, target: str, source_msg, progress_msg, segment: dict = None):
+        """
+        Persist a new broadcast job and start it in the background
+
+        :param client: Client that received the command
+        :param target: Name of a registered BroadcastTarget
+        :param source_msg: Message to broadcast
+        :param progress_msg: Admin message kept updated with progress
+        :param segment: Target-specific selection of recipients, stored on
+            the job so a resumed job reaches the same audience
+        :return: The job document
+        """
+        job = {
+            'target': target,
+            'segment': segment,
+            'source_chat_id': source_msg.chat.id,
+            'source_message_id': source_msg.id,
+            'progress_chat_id': progress_msg.chat.id,
+            'progress_message_id': progress_msg.id,
+            'bot_id': client.me.id,
+            'chunked': self.chunks is not None,
+            'status': RUNNING,
+            'stats': {},
+            'created_at': datetime.now(),
+            'updated_at': datetime.now()
+        }
+        result = await self.jobs.insert_one(job)
+        job['_id'] = result.inserted_id
+        self.start(client, job, fresh=True)
+        return job
+
+    def start(self, client, job: dict, fresh: bool = False):
+        """
+        Run a job document in the background of this process
+
+        :param fresh: The job has never run, so there are no checkpoints to skip
+        """
+        if job['_id'] in self._running:
+            return
+        stop = asyncio.Event()
+        run = self._coordinate if job.get('chunked') else self._run
+        task = asyncio.create_task(run(client, job, stop, fresh))
+        self._running[job['_id']] = (task, stop)
+        task.add_done_callback(lambda _: self._running.pop(job['_id'], None))
+
+    def _owner(self, job: dict):
+        # Only the bot that received the source message can fetch it again
+        return self.shards.for_bot(job.get('bot_id')).client
+
+    async def resume_all(self):
+        """
+        Pick up every job that was running when the process last stopped
+        """
+        async for job in self.jobs.find({'status': RUNNING}):
+            logger.info(f"Resuming broadcast job {job['_id']}")
+            self.start(self._owner(job), job)
+
+    async def get(self, job_id):
+        return await self.jobs.find_one({'_id': job_id})
+
+    async def recent(self, limit: int = 5):
+        return await self.jobs.find().sort('created_at', DESCENDING).limit(limit).to_list(limit)
+
+    async def pause(self, job_id):
+        """
+        Stop a running job after its in-flight sends; it can be resumed later
+
+        :return: True if the job was running
+        """
+        return await self._stop(job_id, PAUSED)
+
+    async def cancel(self, job_id):
+        """
+        Stop a running or paused job for good
+
+        :return: True if the job was running or paused
+        """
+        if await self._stop(job_id, CANCELLED):
+            return True
+        result = await self.jobs.update_one(
+            {'_id': job_id, 'status': PAUSED},
+            {'$set': {'status': CANCELLED, 'updated_at': datetime.now()}}
+        )
+        if result.modified_count and self.chunks is not None:
+            await self.chunks.discard(job_id)
+        return result.modified_count > 0
+
+    async def resume(self, job_id):
+        """
+        Restart a paused job where it left off
+
+        :return: True if the job was paused
+        """
+        job = await self.jobs.find_one_and_update(
+            {'_id': job_id, 'status': PAUSED},
+            {'$set': {'status': RUNNING, 'updated_at': datetime.now()}}
+        )
+        if job is None:
+            return False
+        job['status'] = RUNNING
+        self.start(self._owner(job), job)
+        return True
+
+    async def stop_all(self):
+        """
+        Checkpoint and stop every job in this process, leaving them marked
+        as running so the next startup resumes them; chunks being sent are
+        handed back to the queue
+        """
+        running = list(self._running.values())
+        for _, stop in running:
+            stop.set()
+        await asyncio.gather(
+            self.stop_consuming(),
+            *(task for task, _ in running),
+            return_exceptions=True
+        )
+
+    async def _stop(self, job_id, status: str):
+        running = self._running.get(job_id)
+        if running is None:
+            return False
+        task, stop = running
+        self._stop_status[job_id] = status
+        stop.set()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def _undelivered(self, job_id, recipients, batch_size: int = 500):
+        """
+        Drop recipients that already have a checkpoint for this job
+        """
+        async def unsent(batch):
+            done = set()
+            cursor = self.db.broadcast_deliveries_collection.find(
+                {'job_id': job_id, 'chat_id': {'$in': [chat_id for chat_id, _ in batch]}},
+                {'chat_id': 1, '_id': 0}
+            )
+            async for delivery in cursor:
+                done.add(delivery['chat_id'])
+            return [recipient for recipient in batch if recipient[0] not in done]
+
+        batch = []
+        async for recipient in recipients:
+            batch.append(recipient)
+            if len(batch) >= batch_size:
+                for pending in await unsent(batch):
+                    yield pending
+                batch = []
+        if batch:
+            for pending in await unsent(batch):
+                yield pending
+
+    async def _edit_progress(self, client, job: dict, text: str):
+        await client.edit_message_text(job['progress_chat_id'], job['progress_message_id'], text)
+
+    def _progress_text(self, target: BroadcastTarget, job_id, stats: BroadcastStats, extra: str = ''):
+        # The count is an estimate, so cap it for recipients added mid-run
+        progress = min(100.0, stats.processed / max(stats.total or 0, 1) * 100)
+        eta = stats.eta
+        return (
+            f"{target.title} progress: {progress:.2f}%\n"
+            f"📨 {stats.processed}/{stats.total or '?'} at {stats.throughput:.1f}/s, "
+            f"ETA {timedelta(seconds=int(eta)) if eta is not None else '?'}\n"
+            f"✅ {stats.delivered} · 🚫 {stats.unreachable} · ❌ {stats.failed} · "
+            f"🗑 {stats.dropped} · 🔁 {stats.retried} · ⏳ {stats.flood_waits}\n"
+            f"{extra}"
+            f"🆔 Job: {job_id}"
+        )
+
+    async def _fail(self, job_id, error: Exception):
+        logger.error(f"Broadcast job {job_id} failed: {error}")
+        await self.jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'status': FAILED, 'error': str(error), 'updated_at': datetime.now()}}
+        )
+
+    async def _run(self, client, job: dict, stop: asyncio.Event, fresh: bool):
+        job_id = job['_id']
+        target = self.targets[job['target']]
+        stats = None
+        log = None
+        try:
+            source_msg = await client.get_messages(job['source_chat_id'], job['source_message_id'])
+            total = await target.count(job)
+            stats = BroadcastStats.from_dict(job.get('stats'), total)
+            BROADCAST_PROCESSED.set_function(lambda: stats.processed, job=str(job_id))
+            BROADCAST_TOTAL.set_function(lambda: stats.total or 0, job=str(job_id))
+
+            recipients = target.recipients(job)
+            if not fresh:
+                # Resumed job: skip everyone already checkpointed
+                recipients = self._undelivered(job_id, recipients)
+
+            last_counters = None
+
+            async def report_progress(stats):
+                nonlocal last_counters
+                # Nothing settled since the last sample: skip the API call
+                counters = stats.to_dict()
+                if counters == last_counters:
+                    return
+                await self._edit_progress(client, job, self._progress_text(target, job_id, stats))
+                last_counters = counters
+
+            log = DeliveryLog(self.db, job_id, stats, self.checkpoint_batch, self.checkpoint_interval)
+            log.start()
+
+            def on_result(chat_id, outcome, error):
+                log.record(chat_id, outcome, error)
+                if outcome == UNREACHABLE and target.on_unreachable:
+                    target.on_unreachable(chat_id, unreachable_reason(error))
+
+            # One sender per lane; bots other than the owner re-upload media once
+            senders = [
+                target.make_sender(shard.client, source_msg, client, bucket=shard.bucket) for shard in self.shards
+            ]
+
+            await self.engine.run(
+                recipients,
+                senders,
+                chat_interval=target.chat_interval,
+                total=total,
+                on_progress=report_progress,
+                progress_interval=self.progress_interval,
+                on_result=on_result,
+                stats=stats,
+                stop=stop,
+                route=self.shards.route
+            )
+        except Exception as e:
+            await self._fail(job_id, e)
+            return
+        finally:
+            BROADCAST_PROCESSED.remove(job=str(job_id))
+            BROADCAST_TOTAL.remove(job=str(job_id))
+            if log is not None:
+                await log.close()
+
+        await self._finish(client, job, target, stats, stop)
+
+    async def _coordinate(self, client, job: dict, stop: asyncio.Event, fresh: bool):
+        """
+        Split a chunked job and report its progress until every chunk is
+        done; the sends happen in whichever processes claim the chunks
+        """
+        job_id = job['_id']
+        target = self.targets[job['target']]
+        stats = None
+        try:
+            stats = BroadcastStats.from_dict(job.get('stats'), job.get('total') or await target.count(job))
+            BROADCAST_PROCESSED.set_function(lambda: stats.processed, job=str(job_id))
+            BROADCAST_TOTAL.set_function(lambda: stats.total or 0, job=str(job_id))
+
+            if not job.get('split'):
+                recipients = target.recipients(job)
+                if not fresh:
+                    # A split cut short by a restart is redone from scratch:
+                    # drop every old chunk, give their holders one renewal
+                    # period to notice the lost lease and stop, then leave
+                    # out everyone already checkpointed
+                    await self.chunks.discard(job_id)
+                    await asyncio.sleep(self.chunks.lease_seconds / 3 + self.poll_interval)
+                    recipients = self._undelivered(job_id, recipients)
+                chunk_count, count = await self.chunks.split(
+                    job_id, recipients, self.chunk_size,
+                    # Holders of old chunks may still have been sending
+                    dedupe=not fresh
+                )
+                # Count recipients sent to before the redo so progress adds up
+                delivered = 0 if fresh else await self.db.broadcast_deliveries_collection.count_documents(
+                    {'job_id': job_id}
+                )
+                total = delivered + count
+                job.update(split=True, chunks=chunk_count, total=total)
+                await self.jobs.update_one(
+                    {'_id': job_id},
+                    {'$set': {'split': True, 'chunks': chunk_count, 'total': total, 'updated_at': datetime.now()}}
+                )
+                stats.total = total
+
+            last_text = None
+            edit_after = 0.0
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=self.progress_interval)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+                chunks = await self.chunks.progress(job_id)
+                await self._refresh_stats(job_id, stats)
+                if chunks.get(DONE, 0) >= job['chunks']:
+                    break
+
+                text = self._progress_text(
+                    target, job_id, stats,
+                    f"🧩 Chunks: {chunks.get(DONE, 0)}/{job['chunks']} done, {chunks.get(LEASED, 0)} in progress\n"
+                )
+                if text == last_text or time.monotonic() < edit_after:
+                    continue
+                try:
+                    await self._edit_progress(client, job, text)
+                    last_text = text
+                except MessageNotModified:
+                    last_text = text
+                except FloodWait as e:
+                    edit_after = time.monotonic() + e.value
+                except Exception as e:
+                    logger.warning(f"Progress update failed: {e}")
+        except Exception as e:
+            await self._fail(job_id, e)
+            return
+        finally:
+            BROADCAST_PROCESSED.remove(job=str(job_id))
+            BROADCAST_TOTAL.remove(job=str(job_id))
+
+        stats.finished = time.monotonic()
+        await self._finish(client, job, target, stats, stop)
+
+    async def _refresh_stats(self, job_id, stats: BroadcastStats):
+        # Counters as added up by every process working on the job
+        current = await self.jobs.find_one({'_id': job_id}, {'stats': 1})
+        for name, value in ((current or {}).get('stats') or {}).items():
+            setattr(stats, name, value)
+
+    async def _finish(self, client, job: dict, target: BroadcastTarget, stats: BroadcastStats,
+                      stop: asyncio.Event):
+        job_id = job['_id']
+        if stop.is_set():
+            status = self._stop_status.pop(job_id, None)
+            if status is None:
+                # Process shutdown: stay running so startup resumes it
+                return
+        else:
+            status = COMPLETED
+
+        await self.jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'status': status, 'updated_at': datetime.now()}}
+        )
+        if status == CANCELLED and job.get('chunked'):
+            await self.chunks.discard(job_id)
+
+        headline = {
+            COMPLETED: f"📊 {target.title} Completed!",
+            PAUSED: f"⏸ {target.title} Paused",
+            CANCELLED: f"🛑 {target.title} Cancelled",
+        }[status]
+        try:
+            await self._edit_progress(
+                client, job,
+                f"{headline}\n\n"
+                f"✅ Successful: {stats.delivered}\n"
+                f"🔁 Retried: {stats.retried}\n"
+                f"🗑 Dropped: {stats.dropped}\n"
+                f"❌ Failed: {stats.failed}\n"
+                f"🚫 {target.unreachable_label}: {stats.unreachable}\n"
+                f"⚡ Rate: {stats.rate:.1f} msgs/s\n"
+                f"🆔 Job: {job_id}"
+            )
+        except Exception as e:
+            logger.warning(f"Could not post report for job {job_id}: {e}")
+
+    def start_consuming(self):
+        """
+        Start claiming and sending chunks of chunked jobs in this process
+        """
+        if self.chunks is not None and self._consumer is None:
+            self._consumer_stop.clear()
+            self._consumer = asyncio.create_task(self._consume())
+
+    async def stop_consuming(self):
+        """
+        Stop claiming chunks and hand the ones being sent back to the queue
+        """
+        self._consumer_stop.set()
+        for stop in self._chunk_stops:
+            stop.set()
+        if self._consumer is not None:
+            await asyncio.gather(self._consumer, return_exceptions=True)
+            self._consumer = None
+
+    async def _consume(self):
+        while not self._consumer_stop.is_set():
+            chunk = None
+            try:
+                job_ids = await self.jobs.distinct('_id', {'status': RUNNING, 'chunked': True})
+                # Forget senders of jobs that are no longer running
+                for job_id in set(self._chunk_senders) - set(job_ids):
+                    del self._chunk_senders[job_id]
+                if job_ids:
+                    chunk = await self.chunks.claim(self.worker_name, job_ids)
+                if chunk is not None:
+                    await self._run_chunk(chunk)
+                    continue
+            except Exception as e:
+                logger.error(f"Error consuming broadcast chunks: {e}")
+            try:
+                await asyncio.wait_for(self._consumer_stop.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _heartbeat(self, chunk: dict, stop: asyncio.Event):
+        # Renew well before the lease runs out; stop if the lease was lost
+        # or the job was paused or cancelled meanwhile
+        while not stop.is_set():
+            await asyncio.sleep(self.chunks.lease_seconds / 3)
+            try:
+                job = await self.jobs.find_one({'_id': chunk['job_id']}, {'status': 1})
+                if (job or {}).get('status') != RUNNING or not await self.chunks.renew(chunk['_id'], self.worker_name):
+                    stop.set()
+            except PyMongoError as e:
+                logger.warning(f"Could not renew lease on chunk {chunk['_id']}: {e}")
+
+    async def _run_chunk(self, chunk: dict):
+        job_id = chunk['job_id']
+        job = await self.get(job_id)
+        target = self.targets[job['target']]
+        stop = asyncio.Event()
+        self._chunk_stops.add(stop)
+        heartbeat = asyncio.create_task(self._heartbeat(chunk, stop))
+        log = None
+        try:
+            senders = self._chunk_senders.get(job_id)
+            if senders is None:
+                # The bot that received the command fetches the source once
+                # per process; the other bots re-upload media from it
+                owner = self._owner(job)
+                source_msg = await owner.get_messages(job['source_chat_id'], job['source_message_id'])
+                senders = self._chunk_senders[job_id] = [
+                    target.make_sender(shard.client, source_msg, owner, bucket=shard.bucket)
+                    for shard in self.shards
+                ]
+
+            async def pairs():
+                for chat_id, bots in chunk['recipients']:
+                    yield chat_id, bots
+
+            stats = BroadcastStats(len(chunk['recipients']))
+            # A chunk taken over from another process skips what it already sent
+            if chunk['attempts'] > 1 or chunk.get('dedupe'):
+                recipients = self._undelivered(job_id, pairs())
+            else:
+                recipients = pairs()
+            log = DeliveryLog(self.db, job_id, stats, self.checkpoint_batch, self.checkpoint_interval,
+                              increment=True)
+            log.start()
+
+            def on_result(chat_id, outcome, error):
+                log.record(chat_id, outcome, error)
+                if outcome == UNREACHABLE and target.on_unreachable:
+                    target.on_unreachable(chat_id, unreachable_reason(error))
+
+            await self.engine.run(
+                recipients,
+                senders,
+                chat_interval=target.chat_interval,
+                on_result=on_result,
+                stats=stats,
+                stop=stop,
+                route=self.shards.route
+            )
+        finally:
+            heartbeat.cancel()
+            self._chunk_stops.discard(stop)
+            if log is not None:
+                await log.close()
+
+        if stop.is_set():
+            await self.chunks.release(chunk['_id'], self.worker_name)
+        else:
+            await self.chunks.complete(chunk['_id'], self.worker_name)
@@ -0,0 +1,168 @@
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import LOG_RECORDS_DROPPED
+
+# Attributes every LogRecord has; anything else was passed through extra=
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def event_of(record: logging.LogRecord):
+    """Event type of a record: its 'event' extra, else the logger name"""
+    return getattr(record, 'event', None) or record.name
+
+
+def parse_rates(text: str):
+    """
+    Parse 'event=value,event=value' settings, e.g. LOG_SAMPLE
+
+    :return: Mapping of event type to float
+    """
+    rates = {}
+    for item in (text or '').split(','):
+        if '=' in item:
+            event, value = item.split('=', 1)
+            rates[event.strip()] = float(value)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord):
+        """
+        One JSON object per line: time, level, logger and message, plus
+        every extra field such as chat_id, user_id or latency
+        """
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample: dict = None, rate_limit: dict = None):
+        """
+        Keep a share of each event type's records and cap how many are
+        written per second
+
+        Event types come from the 'event' extra, else the logger name; the
+        key '*' applies to every event type without its own setting.
+        Errors are never sampled away, only rate limited. The first record
+        let through after a suppressed stretch carries a 'suppressed' count.
+
+        :param sample: Mapping of event type to the share of records kept
+        :param rate_limit: Mapping of event type to records per second
+        """
+        super().__init__()
+        self.sample = sample or {}
+        self.rate_limit = rate_limit or {}
+        # event -> [second, records written in it]
+        self._windows = {}
+        # event -> records suppressed since the last one written
+        self._suppressed = {}
+
+    def _setting(self, settings: dict, event: str):
+        return settings.get(event, settings.get('*'))
+
+    def _drop(self, event: str, reason: str):
+        self._suppressed[event] = self._suppressed.get(event, 0) + 1
+        LOG_RECORDS_DROPPED.inc(event=event, reason=reason)
+        return False
+
+    def filter(self, record: logging.LogRecord):
+        event = event_of(record)
+
+        share = self._setting(self.sample, event)
+        if share is not None and record.levelno < logging.ERROR and random.random() >= share:
+            return self._drop(event, 'sampled')
+
+        limit = self._setting(self.rate_limit, event)
+        if limit is not None:
+            second = int(time.monotonic())
+            window = self._windows.get(event)
+            if window is None or window[0] != second:
+                window = self._windows[event] = [second, 0]
+            if window[1] >= limit:
+                return self._drop(event, 'rate_limited')
+            window[1] += 1
+
+        suppressed = self._suppressed.pop(event, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord):
+        """
+        Only merge the message arguments here; the listener thread does
+        the formatting
+        """
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks cannot cross threads safely, render them now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # Never block the event loop on a backed-up log pipeline
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(event=event_of(record), reason='queue_full')
+
+
+def setup_logging(level: str = 'INFO', fmt: str = 'json', sample: dict = None,
+                  rate_limit: dict = None, queue_size: int = 10000, stream=None):
+    """
+    Route every log record through a queue to a background thread that
+    formats and writes it
+
+    The calling thread only filters the record and puts it on the queue;
+    when the queue is full the record is dropped and counted.
+
+    :param level: Root log level
+    :param fmt: 'json' for one JSON object per line, 'text' for plain lines
+    :param sample: Share of records kept per event type, see SamplingFilter
+    :param rate_limit: Records per second per event type
+    :param queue_size: Records buffered before new ones are dropped
+    :param stream: Where to write; stdout by default
+    :return: The started QueueListener; stop() it to flush on exit
+    """
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    records = queue.Queue(maxsize=queue_size)
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(SamplingFilter(sample, rate_limit))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
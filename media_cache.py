@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from pyrogram.errors import (
+    FileIdInvalid,
+    FileReferenceExpired,
+    FileReferenceInvalid,
+    MediaEmpty
+)
+from pymongo.errors import PyMongoError
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Telegram refuses a stored file_id with one of these once it is no longer
+# usable; pyrogram raises ValueError for a file_id it cannot decode
+INVALID_FILE_ERRORS = (FileIdInvalid, FileReferenceExpired, FileReferenceInvalid, MediaEmpty, ValueError)
+
+
+class MediaCache:
+    def __init__(self, db: Database):
+        """
+        Send remote videos by Telegram file_id once they have been uploaded
+
+        The first send of a URL lets Telegram fetch it and records the
+        resulting file_id in MongoDB; later sends reuse the file_id, and a
+        rejected file_id falls back to the URL and is replaced.
+
+        :param db: Database holding the media_cache collection
+        """
+        self.db = db
+        # (bot_id, url) -> file_id; file_ids are only valid for the bot that made them
+        self._file_ids = {}
+        self._locks = {}
+
+    @property
+    def collection(self):
+        return self.db.media_cache_collection
+
+    async def load(self):
+        """
+        Warm the in-memory map from MongoDB at startup
+        """
+        try:
+            async for entry in self.collection.find({}, {'_id': 0}):
+                self._file_ids[(entry['bot_id'], entry['url'])] = entry['file_id']
+            logger.info(f"Loaded {len(self._file_ids)} cached media file IDs")
+        except PyMongoError as e:
+            logger.error(f"Error loading media cache: {e}")
+
+    async def _store(self, key, file_id: str):
+        self._file_ids[key] = file_id
+        bot_id, url = key
+        try:
+            await self.collection.update_one(
+                {'bot_id': bot_id, 'url': url},
+                {'$set': {'file_id': file_id, 'updated_at': datetime.now()}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(f"Error saving media cache entry for {url}: {e}")
+
+    async def send_video(self, client, chat_id: int, url: str, **kwargs):
+        """
+        Send a video given by URL, by cached file_id whenever possible
+
+        :param client: Client to send with
+        :param chat_id: Recipient chat ID
+        :param url: Remote URL of the video
+        :param kwargs: Extra arguments for send_video, e.g. caption
+        """
+        bot_id = client.me.id if getattr(client, 'me', None) else 0
+        key = (bot_id, url)
+
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await client.send_video(chat_id=chat_id, video=file_id, **kwargs)
+            except INVALID_FILE_ERRORS as e:
+                logger.warning(f"Cached file_id for {url} rejected ({e}), re-uploading")
+                if self._file_ids.get(key) == file_id:
+                    del self._file_ids[key]
+
+        # Only one send fetches the URL; concurrent senders wait and reuse its file_id
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                return await client.send_video(chat_id=chat_id, video=file_id, **kwargs)
+
+            sent = await client.send_video(chat_id=chat_id, video=url, **kwargs)
+            if sent is not None and sent.video is not None:
+                await self._store(key, sent.video.file_id)
+            return sent
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers fast local Mongo calls up to Telegram round trips under load
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        """
+        Base class of the metric types
+
+        :param name: Metric name, e.g. 'smokie_join_requests_total'
+        :param documentation: HELP text
+        :param labelnames: Names of the labels every sample carries
+        :param registry: Registry to add the metric to; the default one if None
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._functions = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def set_function(self, function, **labels):
+        """
+        Read the value from a function at scrape time instead of tracking it
+        """
+        self._functions[self._key(labels)] = function
+
+    def remove(self, **labels):
+        """
+        Drop one labelled series, e.g. once a broadcast job has finished
+        """
+        key = self._key(labels)
+        self._values.pop(key, None)
+        self._functions.pop(key, None)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+        for key, function in self._functions.items():
+            try:
+                value = function()
+            except Exception as e:
+                logger.debug(f"Metric {self.name} callback failed: {e}")
+                continue
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    # Only ever grows; functions given to set_function must too
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # Read through set_function; goes up and down
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Per-bucket counts, then sum and count
+            series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        for key, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, series[-2]
+            yield f"{self.name}_count", labels, series[-1]
+
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of metrics rendered together on /metrics
+        """
+        self._metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """
+        Text exposition format understood by Prometheus
+        """
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+# Join requests
+JOIN_REQUEST_SECONDS = Histogram(
+    'smokie_join_request_seconds',
+    'End-to-end latency from receiving a join request to its approval',
+)
+JOIN_REQUESTS = Counter(
+    'smokie_join_requests_total',
+    'Join requests handled, by outcome (approved, skipped, dropped, error)',
+    ['outcome'],
+)
+APPROVAL_LAG_SECONDS = Histogram(
+    'smokie_approval_lag_seconds',
+    'Time join requests wait in their chat queue before approval starts',
+)
+
+# Telegram sends
+SENDS = Counter(
+    'smokie_sends_total',
+    'Messages sent, by kind (broadcast, welcome) and outcome',
+    ['kind', 'outcome'],
+)
+FLOOD_WAITS = Counter(
+    'smokie_flood_waits_total',
+    'FloodWait errors received, by the component that hit them',
+    ['source'],
+)
+FLOOD_WAIT_SECONDS = Counter(
+    'smokie_flood_wait_seconds_total',
+    'Seconds Telegram asked the bot to wait, by component',
+    ['source'],
+)
+
+# Broadcasts
+BROADCAST_PROCESSED = Gauge(
+    'smokie_broadcast_processed',
+    'Recipients settled so far in a running broadcast job',
+    ['job'],
+)
+BROADCAST_TOTAL = Gauge(
+    'smokie_broadcast_recipients',
+    'Expected recipients of a running broadcast job',
+    ['job'],
+)
+BROADCASTS_RUNNING = Gauge(
+    'smokie_broadcasts_running',
+    'Broadcast jobs running in this process',
+)
+
+# Work queues
+QUEUE_DEPTH = Gauge(
+    'smokie_queue_depth',
+    'Items waiting in a work queue',
+    ['queue'],
+)
+QUEUE_DROPPED = Counter(
+    'smokie_queue_dropped_total',
+    'Items dropped by a full work queue since startup',
+    ['queue'],
+)
+
+# Recently seen users
+SEEN_CACHE_LOOKUPS = Counter(
+    'smokie_seen_cache_lookups_total',
+    'User upserts checked against the recently seen cache, by result',
+    ['result'],
+)
+SEEN_CACHE_SIZE = Gauge(
+    'smokie_seen_cache_size',
+    'Users held in the recently seen cache',
+)
+
+# MongoDB
+MONGO_COMMAND_SECONDS = Histogram(
+    'smokie_mongo_command_seconds',
+    'Latency of MongoDB commands, by command name',
+    ['command'],
+)
+MONGO_COMMAND_FAILURES = Counter(
+    'smokie_mongo_command_failures_total',
+    'MongoDB commands that failed, by command name',
+    ['command'],
+)
+
+# Logging
+LOG_RECORDS_DROPPED = Counter(
+    'smokie_log_records_dropped_total',
+    'Log records not written, by event and reason (sampled, rate_limited, queue_full)',
+    ['event', 'reason'],
+)
+
+
+class MongoLatencyListener(monitoring.CommandListener):
+    """
+    Time every command the driver sends, whichever code path issued it
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name)
+        MONGO_COMMAND_FAILURES.inc(command=event.command_name)
+
+
+class MetricsServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 9464, registry: Registry = None):
+        """
+        Minimal HTTP server answering GET /metrics
+
+        :param host: Interface to listen on; local only by default
+        :param port: TCP port
+        :param registry: Metrics to serve; the default registry if None
+        """
+        self.host = host
+        self.port = port
+        self.registry = registry if registry is not None else REGISTRY
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers; the request has no body
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = self.registry.render().encode()
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+
+from metrics import SEEN_CACHE_LOOKUPS, SEEN_CACHE_SIZE
+
+
+class RecentlySeenCache:
+    def __init__(self, max_entries: int = 100000, freshness: float = 300.0):
+        """
+        Remember users written recently so repeated upserts can be skipped
+
+        A user seen again within the freshness window, with the same
+        username and through a bot already recorded for them, needs no full
+        upsert: last_seen would only move by a few seconds. Flags set by
+        other processes are not seen here, so WriteBehindBuffer still sends
+        a flag-clearing update for skipped users. Entries are
+        evicted least recently used first once max_entries is reached, which
+        caps memory at roughly 200 bytes per entry.
+
+        :param max_entries: Most users remembered at once
+        :param freshness: Seconds a write keeps a user fresh; 0 disables
+            the cache
+        """
+        self.max_entries = max_entries
+        self.freshness = freshness
+        # user_id -> (username, bot IDs, time of the last write)
+        self._entries = OrderedDict()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        SEEN_CACHE_LOOKUPS.set_function(lambda: self.hits, result='hit')
+        SEEN_CACHE_LOOKUPS.set_function(lambda: self.misses, result='miss')
+        SEEN_CACHE_SIZE.set_function(lambda: len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hit_ratio, 3),
+        }
+
+    def should_write(self, user_id: int, username: str, bot_id: int = None):
+        """
+        Tell whether a user upsert is needed, and if so record it as written
+
+        :param user_id: Telegram user ID
+        :param username: Username the upsert would store
+        :param bot_id: Bot the upsert would record for the user
+        :return: False if an identical write happened within the window
+        """
+        if not self.freshness:
+            return True
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            cached_username, bots, written_at = entry
+            if (cached_username == username and (bot_id is None or bot_id in bots)
+                    and now - written_at < self.freshness):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return False
+            bots = bots | {bot_id} if bot_id is not None else bots
+        else:
+            bots = frozenset() if bot_id is None else frozenset((bot_id,))
+
+        self.misses += 1
+        self._entries[user_id] = (username, bots, now)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def invalidate(self, user_id: int):
+        """
+        Forget a user, e.g. once they were flagged unreachable, so the next
+        interaction is written and clears the flag
+        """
+        self._entries.pop(user_id, None)
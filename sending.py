@@ -0,0 +1,128 @@
+import asyncio
+import copy
+
+from pyrogram.enums import MessageMediaType
+from pyrogram.errors import PeerIdInvalid
+from pyrogram.types import Message
+
+from broadcast import PeerUnresolved, TokenBucket
+
+# Media kinds whose send method takes no caption
+NO_CAPTION = {MessageMediaType.STICKER, MessageMediaType.VIDEO_NOTE}
+
+
+class PreparedSend:
+    def __init__(self, client, source_msg: Message, source_client=None, bucket: TokenBucket = None):
+        """
+        Analyze a broadcast message once and send copies of it
+
+        Calling the instance with a chat ID sends one copy with a single API
+        call, the same way copy_message would but without re-fetching the
+        source for every recipient. Captions, text entities and inline
+        keyboards are kept as they are.
+
+        - Any media with a file_id (photo, video, document, audio, voice,
+          animation, sticker, video note) goes through send_cached_media.
+        - Text goes through send_message with its entities.
+        - Anything else (polls, locations, ...) falls back to Message.copy.
+
+        file_ids only work for the bot that received them, so when the
+        message was received by another bot (source_client), the first send
+        downloads the media through that bot and uploads it again; every
+        later send reuses the new file_id. Uploads run one at a time, and
+        while one fails because of its recipient, the next one reuses the
+        downloaded bytes.
+
+        With a bucket, chats missing from the client's session, e.g. in a
+        worker process that logged in with a fresh one, are resolved first
+        and the lookup is paid for with a token of the bucket. A chat
+        Telegram will not resolve raises PeerUnresolved rather than the
+        PeerIdInvalid that would mark it unreachable.
+
+        :param client: Client to send with
+        :param source_msg: Message to broadcast
+        :param source_client: Client that received source_msg, if not client
+        :param bucket: Send budget of client, to resolve unknown chats with
+        """
+        self.client = client
+        self.source_msg = source_msg
+        self.bucket = bucket
+        self.source_client = source_client if source_client is not client else None
+
+        media = getattr(source_msg, source_msg.media.value, None) if source_msg.media else None
+        file_id = getattr(media, 'file_id', None)
+
+        if file_id:
+            self.kind = 'cached_media'
+            self._send = client.send_cached_media
+            self._kwargs = {
+                'file_id': file_id,
+                'caption': source_msg.caption or "",
+                'caption_entities': source_msg.caption_entities,
+                'reply_markup': source_msg.reply_markup
+            }
+        elif source_msg.text:
+            self.kind = 'text'
+            self._send = client.send_message
+            self._kwargs = {
+                'text': source_msg.text,
+                'entities': source_msg.entities,
+                'reply_markup': source_msg.reply_markup
+            }
+        else:
+            self.kind = 'copy'
+            if self.source_client is not None:
+                # Message.copy sends through the client the message is bound to
+                source_msg = copy.copy(source_msg)
+                source_msg._client = client
+            self._send = source_msg.copy
+            self._kwargs = {}
+
+        self._upload_lock = None
+        self._media_data = None
+        if self.kind == 'cached_media' and self.source_client is not None:
+            self.kind = 'upload'
+            self._upload_lock = asyncio.Lock()
+
+    async def _upload(self, chat_id: int):
+        media_type = self.source_msg.media
+        if self._media_data is None:
+            self._media_data = await self.source_client.download_media(self.source_msg, in_memory=True)
+        data = self._media_data
+        data.seek(0)
+
+        kwargs = {'reply_markup': self._kwargs['reply_markup']}
+        if media_type not in NO_CAPTION:
+            kwargs['caption'] = self._kwargs['caption']
+            kwargs['caption_entities'] = self._kwargs['caption_entities']
+        send = getattr(self.client, f"send_{media_type.value}")
+        sent = await send(chat_id, data, **kwargs)
+
+        # Every later send goes by the file_id this bot now owns
+        self._kwargs['file_id'] = getattr(sent, media_type.value).file_id
+        self._send = self.client.send_cached_media
+        self.kind = 'cached_media'
+        self._media_data = None
+        return sent
+
+    async def _resolve(self, chat_id: int):
+        try:
+            await self.client.storage.get_peer_by_id(chat_id)
+            return
+        except KeyError:
+            pass
+        # Resolving an unknown ID is an API call of its own
+        await self.bucket.acquire()
+        try:
+            await self.client.resolve_peer(chat_id)
+        except PeerIdInvalid as e:
+            raise PeerUnresolved(chat_id) from e
+
+    async def __call__(self, chat_id: int):
+        if self.bucket is not None:
+            await self._resolve(chat_id)
+        if self.kind == 'upload':
+            async with self._upload_lock:
+                if self.kind == 'upload':
+                    return await self._upload(chat_id)
+        return await self._send(chat_id=chat_id, **self._kwargs)
@@ -0,0 +1,145 @@
+import time
+
+from broadcast import TokenBucket
+
+# claims_chat calls between sweeps for chats gone quiet
+PRUNE_EVERY = 1000
+
+
+class Shard:
+    def __init__(self, index: int, client, bucket: TokenBucket):
+        """
+        One bot token served by this process
+
+        :param index: Position of the shard, also its broadcast lane
+        :param client: Started pyrogram Client for the token
+        :param bucket: Send budget of the token
+        """
+        self.index = index
+        self.client = client
+        self.bucket = bucket
+
+    @property
+    def bot_id(self):
+        me = getattr(self.client, 'me', None)
+        return me.id if me else None
+
+
+class ShardSet:
+    def __init__(self, shards, presence_ttl: float = 600.0, takeover_after: float = 5.0):
+        """
+        Spread work over several bot tokens running in one event loop
+
+        Broadcast recipients go to a bot that can reach them, chosen by a
+        hash of the chat ID so consecutive broadcasts keep each recipient on
+        the same token. Join requests for a chat reach every bot that is an
+        admin there; each chat is assigned to exactly one of the bots seen in
+        it recently, and the others ignore its requests. A bot that stops
+        getting a chat's updates, e.g. because it was removed, loses the
+        chat once the others have received two it missed.
+
+        :param shards: Shards in lane order; the first one is the primary
+            bot, which owns recipients recorded before sharding
+        :param presence_ttl: Seconds a bot counts as present in a chat after
+            it last received an update from it
+        :param takeover_after: Seconds a bot that has missed a chat's
+            updates may stay silent there before it counts as gone
+        """
+        self.shards = list(shards)
+        self.presence_ttl = presence_ttl
+        self.takeover_after = takeover_after
+        # chat_id -> {shard index: (last update time, updates received)}
+        self._presence = {}
+        self._calls = 0
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    @property
+    def primary(self):
+        return self.shards[0]
+
+    @property
+    def clients(self):
+        return [shard.client for shard in self.shards]
+
+    def for_client(self, client):
+        """
+        Shard of a client, e.g. the one an update arrived on
+        """
+        for shard in self.shards:
+            if shard.client is client:
+                return shard
+        raise KeyError("Client is not part of this shard set")
+
+    def for_bot(self, bot_id: int):
+        """
+        Shard of a bot ID, falling back to the primary for unknown bots
+        """
+        for shard in self.shards:
+            if shard.bot_id == bot_id:
+                return shard
+        return self.primary
+
+    def lane_for(self, chat_id: int, bots=()):
+        """
+        Lane a recipient is sent through
+
+        :param chat_id: Recipient chat ID
+        :param bots: IDs of the bots known to reach the recipient
+        """
+        lanes = [shard.index for shard in self.shards if shard.bot_id in bots]
+        if not lanes:
+            return self.primary.index
+        return lanes[chat_id % len(lanes)]
+
+    def route(self, recipient):
+        """
+        Map a (chat_id, bots) recipient to (chat_id, lane) for BroadcastEngine
+        """
+        chat_id, bots = recipient
+        return chat_id, self.lane_for(chat_id, bots)
+
+    def _prune(self, now: float):
+        # Forget chats no bot has heard from within the TTL
+        stale = [
+            chat_id for chat_id, seen in self._presence.items()
+            if all(now - at > self.presence_ttl for at, _ in seen.values())
+        ]
+        for chat_id in stale:
+            del self._presence[chat_id]
+
+    def claims_chat(self, client, chat_id: int):
+        """
+        Record that a bot received an update from a chat and tell whether
+        that bot is the one handling the chat
+
+        Bots only learn about each other through updates, so two bots may
+        both handle the first requests of a chat; approving twice is
+        harmless because the second approval simply fails.
+        """
+        if len(self.shards) == 1:
+            return True
+        index = self.for_client(client).index
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            self._prune(now)
+        seen = self._presence.setdefault(chat_id, {})
+        # Every bot in a chat receives each of its updates, so their counts
+        # move together; a bot joining starts level with the others, which
+        # may or may not have counted this update yet
+        at, count = seen.get(index) or (now, max((count for _, count in seen.values()), default=1) - 1)
+        seen[index] = (now, count + 1)
+        newest = max(count for _, count in seen.values())
+        for i, (at, count) in list(seen.items()):
+            # Missed updates the others received and has been silent since:
+            # forget the bot until it gets one from the chat again
+            if newest - count > 1 and now - at > self.takeover_after:
+                del seen[i]
+
+        present = sorted(i for i, (at, _) in seen.items() if now - at <= self.presence_ttl)
+        return present[chat_id % len(present)] == index
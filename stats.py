@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class StatsService:
+    def __init__(self, db: Database):
+        """
+        Bot statistics read from rollups and indexed counts
+
+        Joins per day and per chat are kept in the daily_stats and
+        chat_stats rollups, which the write-behind buffer increments with
+        every approved join and every flush that inserts new users, so a
+        summary reads a few small documents instead of scanning users.
+        rebuild() recomputes the rollups server-side from memberships.
+
+        :param db: Database holding the collections and rollups
+        """
+        self.db = db
+
+    async def summary(self, days: int = 7, top: int = 10):
+        """
+        Totals, blocked ratio, recent days and busiest chats
+
+        :param days: Number of days of joins to include, today included
+        :param top: Number of chats to rank
+        :return: Dict of users, blocked_users, blocked_ratio, channels,
+            groups, restricted_groups, daily and top_chats
+        """
+        db = self.db
+        users = await db.users_collection.estimated_document_count()
+        # Both counts use the indexes on blocked
+        blocked_users = await db.users_collection.count_documents({'blocked': True})
+        restricted_groups = await db.groups_collection.count_documents({'blocked': True})
+
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        daily = await db.daily_stats_collection.find(
+            {'day': {'$gte': since}},
+            {'_id': 0}
+        ).sort('day', -1).to_list(days)
+        top_chats = await db.chat_stats_collection.find(
+            {},
+            {'_id': 0, 'chat_id': 1, 'name': 1, 'joins': 1}
+        ).sort('joins', DESCENDING).limit(top).to_list(top)
+
+        return {
+            'users': users,
+            'blocked_users': blocked_users,
+            'blocked_ratio': blocked_users / users if users else 0.0,
+            'channels': await db.channels_collection.estimated_document_count(),
+            'groups': await db.groups_collection.estimated_document_count(),
+            'restricted_groups': restricted_groups,
+            'daily': daily,
+            'top_chats': top_chats,
+        }
+
+    async def rebuild(self):
+        """
+        Recompute the join rollups from the memberships collection with
+        aggregation pipelines that write straight into them
+
+        Memberships hold one document per user and chat, so rebuilt counts
+        are distinct members by the day they first joined; repeated joins
+        counted live since are replaced. Join counts of days and chats
+        without memberships are cleared, other fields such as new_users and
+        chat names are kept.
+        """
+        db = self.db
+        await db.chat_stats_collection.update_many({}, {'$unset': {'joins': '', 'last_join': ''}})
+        await db.daily_stats_collection.update_many({}, {'$unset': {'joins': ''}})
+        await db.memberships_collection.aggregate([
+            {'$group': {
+                '_id': '$chat_id',
+                'joins': {'$sum': 1},
+                'last_join': {'$max': '$last_joined'},
+            }},
+            {'$project': {'_id': 0, 'chat_id': '$_id', 'joins': 1, 'last_join': 1}},
+            {'$merge': {'into': db.chat_stats_collection.name, 'on': 'chat_id',
+                        'whenMatched': 'merge', 'whenNotMatched': 'insert'}},
+        ], allowDiskUse=True)
+        await db.memberships_collection.aggregate([
+            {'$group': {
+                '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$first_joined'}},
+                'joins': {'$sum': 1},
+            }},
+            {'$project': {'_id': 0, 'day': '$_id', 'joins': 1}},
+            {'$merge': {'into': db.daily_stats_collection.name, 'on': 'day',
+                        'whenMatched': 'merge', 'whenNotMatched': 'insert'}},
+        ], allowDiskUse=True)
+        logger.info("Rebuilt join rollups from memberships")
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from pyrogram.errors import FloodWait, RPCError
+from pyrogram.raw import functions, types
+
+from broadcast import TokenBucket
+from database import Database
+from metrics import FLOOD_WAIT_SECONDS, FLOOD_WAITS
+
+logger = logging.getLogger(__name__)
+
+
+class JoinRequestSweeper:
+    def __init__(self, db: Database, rate: float = 1.0):
+        """
+        Approve join requests that piled up while the bot was not listening
+
+        Works chat by chat over every known channel and group, clearing each
+        backlog with a single approve-all call rather than one approval per
+        user. Telegram only allows this for user accounts, so the client
+        passed to sweep() is normally an admin user session.
+
+        :param db: Database listing the known chats
+        :param rate: Chats swept per second
+        """
+        self.db = db
+        self.bucket = TokenBucket(rate, capacity=1)
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def pending_count(self, client, chat_id: int):
+        """
+        Number of pending join requests, read from the chat's full info
+        """
+        peer = await client.resolve_peer(chat_id)
+        if isinstance(peer, types.InputPeerChannel):
+            full = await client.invoke(functions.channels.GetFullChannel(
+                channel=types.InputChannel(channel_id=peer.channel_id, access_hash=peer.access_hash)
+            ))
+        else:
+            full = await client.invoke(functions.messages.GetFullChat(chat_id=peer.chat_id))
+        return full.full_chat.requests_pending or 0
+
+    async def _sweep_chat(self, client, chat_id: int):
+        for _ in range(3):
+            await self.bucket.acquire()
+            try:
+                pending = await self.pending_count(client, chat_id)
+                if pending:
+                    await client.approve_all_chat_join_requests(chat_id)
+                return pending
+            except FloodWait as e:
+                logger.warning(f"Flood wait for {e.value} seconds while sweeping {chat_id}",
+                               extra={'event': 'flood_wait', 'chat_id': chat_id, 'wait': e.value})
+                FLOOD_WAITS.inc(source='sweep')
+                FLOOD_WAIT_SECONDS.inc(e.value, source='sweep')
+                self.bucket.pause(e.value)
+        return 0
+
+    async def sweep(self, client):
+        """
+        Clear pending join requests in every known chat
+
+        :param client: Client with admin rights in the chats
+        :return: Mapping of chat_id to (chat name, requests approved) for
+            chats that had a backlog, and the number of chats that failed
+        """
+        async with self._lock:
+            cleared = {}
+            failed = 0
+            async for chat in self.db.iter_chats():
+                try:
+                    count = await self._sweep_chat(client, chat['chat_id'])
+                except RPCError as e:
+                    # Not an admin any more, chat gone, or no invite-request rights
+                    failed += 1
+                    logger.debug(f"Could not sweep {chat['chat_id']}: {e}")
+                    continue
+                if count:
+                    cleared[chat['chat_id']] = (chat.get('name'), count)
+                    logger.info(f"Approved {count} pending join requests in {chat.get('name')} ({chat['chat_id']})")
+            return cleared, failed
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+from string import Formatter
+
+from pymongo import DESCENDING
+from pymongo.errors import PyMongoError
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Message kinds and the placeholders their text may use
+START = 'start'
+JOIN = 'join'
+FIELDS = {
+    START: {'first_name', 'mention', 'user_id'},
+    JOIN: {'first_name', 'mention', 'user_id', 'chat_title', 'chat_id'},
+}
+# Placeholder allowed in button URLs, filled with the sending bot's username
+BUTTON_FIELDS = {'bot_username'}
+
+
+def placeholders(text: str):
+    return {name for _, name, _, _ in Formatter().parse(text) if name is not None}
+
+
+class MessageTemplate:
+    def __init__(self, kind: str, text: str, video_url: str = None, buttons=()):
+        """
+        A welcome message checked once and rendered per recipient
+
+        Placeholders are validated when the template is built, so a typo in
+        a stored template is reported at load time rather than on every
+        join. Reply markups are built once per bot and shared by every
+        send, since pyrogram only reads them.
+
+        :param kind: START or JOIN
+        :param text: Caption with str.format placeholders, e.g. {mention}
+        :param video_url: Video sent with the caption, or None for text only
+        :param buttons: Rows of {'text', 'url'} mappings; URLs may use
+            {bot_username}
+        """
+        unknown = placeholders(text) - FIELDS[kind]
+        if unknown:
+            raise ValueError(f"Unknown placeholders in {kind} template: {', '.join(sorted(unknown))}")
+        rows = tuple(tuple((button['text'], button['url']) for button in row) for row in buttons)
+        for row in rows:
+            for label, url in row:
+                unknown = placeholders(url) - BUTTON_FIELDS
+                if unknown:
+                    raise ValueError(f"Unknown placeholders in button {label!r}: {', '.join(sorted(unknown))}")
+
+        self.kind = kind
+        self.text = text
+        self.video_url = video_url
+        self.rows = rows
+        # Constant captions are returned as they are
+        self._static = not placeholders(text)
+        self._markups = {}
+
+    def render(self, **values):
+        """
+        Fill in the caption
+
+        :param values: Placeholder values; unused ones are ignored
+        """
+        if self._static:
+            return self.text
+        return self.text.format_map(values)
+
+    def reply_markup(self, bot_username: str = None):
+        """
+        Keyboard for a bot, built on first use and reused afterwards
+
+        :param bot_username: Username filled into button URLs
+        :return: InlineKeyboardMarkup, or None without buttons
+        """
+        if not self.rows:
+            return None
+        markup = self._markups.get(bot_username)
+        if markup is None:
+            markup = self._markups[bot_username] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(label, url=url.format(bot_username=bot_username)) for label, url in row]
+                for row in self.rows
+            ])
+        return markup
+
+
+class TemplateStore:
+    def __init__(self, db: Database, defaults: dict, path: str = None, reload_interval: float = 60.0):
+        """
+        Welcome templates per message kind and chat, kept in memory
+
+        Templates come from three layers, later ones overriding earlier
+        ones field by field: the built-in defaults, an optional JSON file
+        and the templates collection. Entries with a chat_id only apply to
+        that chat. Lookups never touch MongoDB; a background task polls the
+        file's mtime and the collection's latest updated_at and reloads
+        everything when either changes.
+
+        :param db: Database holding the templates collection
+        :param defaults: Mapping of kind to {'text', 'video_url', 'buttons'}
+        :param path: JSON file with a list of template entries, if any
+        :param reload_interval: Seconds between change checks; 0 disables
+            hot reload
+        """
+        self.db = db
+        self.defaults = defaults
+        self.path = path
+        self.reload_interval = reload_interval
+        # (kind, chat_id or None) -> MessageTemplate
+        self._templates = self._compile([])
+        self._version = None
+        self._task = None
+
+    @property
+    def collection(self):
+        return self.db.templates_collection
+
+    def get(self, kind: str, chat_id: int = None):
+        """
+        Template for a chat, falling back to the kind's default
+
+        :param kind: START or JOIN
+        :param chat_id: Chat the message is about, if any
+        """
+        template = self._templates.get((kind, chat_id)) if chat_id is not None else None
+        return template or self._templates[(kind, None)]
+
+    def _compile(self, entries):
+        fields = {kind: dict(values) for kind, values in self.defaults.items()}
+        per_chat = {}
+        for entry in entries:
+            values = {name: entry[name] for name in ('text', 'video_url', 'buttons') if name in entry}
+            if entry.get('chat_id') is None:
+                fields[entry['kind']].update(values)
+            else:
+                per_chat.setdefault((entry['kind'], entry['chat_id']), {}).update(values)
+
+        templates = {(kind, None): MessageTemplate(kind, **values) for kind, values in fields.items()}
+        for (kind, chat_id), values in per_chat.items():
+            # Fields a chat does not override come from the kind's default
+            templates[(kind, chat_id)] = MessageTemplate(kind, **{**fields[kind], **values})
+        return templates
+
+    def _read_file(self):
+        if not self.path:
+            return []
+        with open(self.path, encoding='utf-8') as file:
+            return json.load(file)
+
+    async def _current_version(self):
+        mtime = os.stat(self.path).st_mtime if self.path and os.path.exists(self.path) else None
+        latest = await self.collection.find_one({}, {'updated_at': 1}, sort=[('updated_at', DESCENDING)])
+        count = await self.collection.count_documents({})
+        return mtime, count, latest and latest.get('updated_at')
+
+    async def load(self):
+        """
+        Read and compile every template; on any error the templates in use
+        are kept
+
+        :return: True if the new templates were swapped in
+        """
+        try:
+            version = await self._current_version()
+            entries = self._read_file()
+            entries += await self.collection.find({}, {'_id': 0}).to_list(None)
+            templates = self._compile(entries)
+        except (OSError, ValueError, KeyError, TypeError, PyMongoError) as e:
+            logger.error(f"Error loading templates, keeping the current ones: {e}")
+            return False
+        self._templates = templates
+        self._version = version
+        logger.info(f"Loaded {len(templates)} message templates")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if await self._current_version() != self._version:
+                    await self.load()
+            except (OSError, PyMongoError) as e:
+                logger.warning(f"Could not check templates for changes: {e}")
+
+    def start(self):
+        """
+        Start polling for template changes
+        """
+        if self._task is None and self.reload_interval:
+            self._task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
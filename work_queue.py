@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+
+from metrics import QUEUE_DEPTH, QUEUE_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    def __init__(self, name: str, handler, workers: int = 4, maxsize: int = 1000,
+                 put_timeout: float = 0.0):
+        """
+        Bounded queue drained by a pool of workers, with backpressure
+
+        When the queue is full, submit() waits up to put_timeout seconds for
+        room and then drops the item, so producers are slowed down but never
+        stalled indefinitely.
+
+        :param name: Name used in logs and metrics
+        :param handler: Coroutine function called with each item
+        :param workers: Number of concurrent workers
+        :param maxsize: Items the queue holds before applying backpressure
+        :param put_timeout: Longest time submit() waits for room
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+
+        # Metrics
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        QUEUE_DEPTH.set_function(lambda: self.depth, queue=name)
+        QUEUE_DROPPED.set_function(lambda: self.dropped, queue=name)
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_lag': round(self.last_lag, 3),
+            'max_lag': round(self.max_lag, 3),
+        }
+
+    async def submit(self, item):
+        """
+        Queue an item for the workers
+
+        :return: False if the item was dropped because the queue stayed full
+        """
+        entry = (time.monotonic(), item)
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            try:
+                if self.put_timeout <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(self._queue.put(entry), timeout=self.put_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning(f"{self.name} queue full, dropping item")
+                return False
+        self.submitted += 1
+        return True
+
+    async def _work(self):
+        while True:
+            enqueued, item = await self._queue.get()
+            try:
+                # Time the item spent waiting for a worker
+                self.last_lag = time.monotonic() - enqueued
+                self.max_lag = max(self.max_lag, self.last_lag)
+                await self.handler(item)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error in {self.name} worker: {e}")
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        """
+        Start the worker pool
+        """
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = None):
+        """
+        Wait for queued items to be processed, then stop the workers
+
+        :param timeout: Longest time to wait for the queue to drain
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.name} queue closed with {self.depth} items left")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,305 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from database import Database, chat_update, membership_update, reachable_update, unreachable_update, user_update
+from seen_cache import RecentlySeenCache
+
+logger = logging.getLogger(__name__)
+
+
+def merge_update(existing: dict, update: dict):
+    """
+    Fold a newer update document into an older one for the same key
+
+    Later values win field by field, which is what the individual upserts
+    would have produced had they been applied one after another; $addToSet
+    lists are joined and $inc amounts added up instead. A field set by one
+    and unset by the other ends up as the newer one left it.
+
+    :param existing: Update document already pending for the key
+    :param update: Newer update document for the same key
+    """
+    for operator, fields in update.items():
+        if operator == '$addToSet':
+            merged = existing.setdefault(operator, {})
+            for field, value in fields.items():
+                if field in merged:
+                    merged[field] = {'$each': merged[field]['$each'] + value['$each']}
+                else:
+                    merged[field] = value
+        elif operator == '$inc':
+            merged = existing.setdefault(operator, {})
+            for field, value in fields.items():
+                merged[field] = merged.get(field, 0) + value
+        else:
+            existing.setdefault(operator, {}).update(fields)
+            opposite = {'$set': '$unset', '$unset': '$set'}.get(operator)
+            if opposite in existing:
+                for field in fields:
+                    existing[opposite].pop(field, None)
+                if not existing[opposite]:
+                    del existing[opposite]
+    return existing
+
+
+class WriteBehindBuffer:
+    def __init__(self, db: Database, flush_interval: float = 0.5, max_pending: int = 1000,
+                 seen_cache: RecentlySeenCache = None):
+        """
+        Coalesce user/channel/group upserts and flush them in bulk
+
+        Exposes the same add_user/add_channel/add_group coroutines as Database,
+        plus delivery-outcome flags, but they only record the write; a background task flushes everything
+        pending every flush_interval seconds, or sooner once max_pending keys
+        are waiting.
+
+        :param db: Database to flush into
+        :param flush_interval: Longest time a write may sit in the buffer
+        :param max_pending: Pending key count that triggers an early flush
+        :param seen_cache: Skips user upserts identical to a recent one
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.seen_cache = seen_cache
+
+        # (collection, key field, upsert) -> {key: merged update document}.
+        # A key is pending in at most one of a collection's slots: a flag
+        # for a key with a pending upsert is folded into the upsert, and an
+        # upsert takes over a pending flag, so the last write wins.
+        self._pending = {
+            (db.users_collection, 'user_id', False): {},
+            (db.groups_collection, 'chat_id', False): {},
+            (db.users_collection, 'user_id', True): {},
+            (db.channels_collection, 'chat_id', True): {},
+            (db.groups_collection, 'chat_id', True): {},
+            (db.memberships_collection, ('user_id', 'chat_id'), True): {},
+            # Stats rollups, see stats.py
+            (db.daily_stats_collection, 'day', True): {},
+            (db.chat_stats_collection, 'chat_id', True): {},
+        }
+        self._pending_count = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+        # Counters
+        self.submitted = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+
+    @property
+    def coalescing_ratio(self):
+        """Submitted upserts per document actually written"""
+        return self.submitted / self.written if self.written else 0.0
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'written': self.written,
+            'flushes': self.flushes,
+            'failed': self.failed,
+            'pending': self._pending_count,
+            'coalescing_ratio': round(self.coalescing_ratio, 2),
+        }
+
+    def _slot(self, collection, key_field: str, key, upsert: bool):
+        # Pending map a write for key goes into, moving a pending flag over
+        # into the upsert slot when an upsert for the same key arrives
+        pending = self._pending[(collection, key_field, upsert)]
+        other = self._pending.get((collection, key_field, not upsert))
+        if other is None or key not in other:
+            return pending
+        if not upsert:
+            return other
+        pending[key] = other.pop(key)
+        return pending
+
+    def _submit(self, collection, key_field: str, key, update: dict, upsert: bool = True):
+        pending = self._slot(collection, key_field, key, upsert)
+        if key in pending:
+            merge_update(pending[key], update)
+        else:
+            pending[key] = update
+            self._pending_count += 1
+        self.submitted += 1
+
+        if self._pending_count >= self.max_pending:
+            self._wakeup.set()
+
+    async def add_user(self, user_id: int, username: str, bot_id: int = None):
+        """
+        Queue a user upsert
+
+        :param user_id: Telegram user ID
+        :param username: Telegram username
+        :param bot_id: ID of the bot the user interacted with
+        """
+        self._submit_user(user_id, username, bot_id)
+
+    def _submit_user(self, user_id: int, username: str, bot_id: int = None):
+        if self.seen_cache is not None and not self.seen_cache.should_write(user_id, username, bot_id):
+            # Another process may have flagged the user since the cached
+            # write; only clear such a flag, which costs no write otherwise
+            self._submit(self.db.users_collection, 'user_id', user_id, reachable_update(), upsert=False)
+            return
+        self._submit(self.db.users_collection, 'user_id', user_id, user_update(username, bot_id))
+
+    async def add_users(self, users, bot_id: int = None):
+        """
+        Queue upserts for several users at once; they share one bulk write
+
+        :param users: Iterable of (user_id, username) pairs
+        :param bot_id: ID of the bot the users interacted with
+        """
+        for user_id, username in users:
+            self._submit_user(user_id, username, bot_id)
+
+    def mark_user_unreachable(self, user_id: int, reason: str):
+        """
+        Queue flagging a user that can no longer be messaged; never creates
+        a document
+
+        :param user_id: Telegram user ID
+        :param reason: Why sends fail, e.g. 'blocked' or 'deactivated'
+        """
+        if self.seen_cache is not None:
+            self.seen_cache.invalidate(user_id)
+        self._submit(self.db.users_collection, 'user_id', user_id, unreachable_update(reason), upsert=False)
+
+    def mark_group_unreachable(self, chat_id: int, reason: str):
+        """
+        Queue flagging a group the bot can no longer post in
+
+        :param chat_id: Telegram chat ID of the group
+        :param reason: Why sends fail, e.g. 'forbidden'
+        """
+        self._submit(self.db.groups_collection, 'chat_id', chat_id, unreachable_update(reason), upsert=False)
+
+    async def add_channel(self, user_id: int, channel_name: str, chat_id: int, bot_id: int = None):
+        """
+        Queue a channel upsert
+
+        :param user_id: ID of user who added the channel; None leaves the
+            recorded one unchanged
+        :param channel_name: Name of the channel
+        :param chat_id: Telegram chat ID of the channel
+        :param bot_id: ID of the bot added to the channel
+        """
+        self._submit(self.db.channels_collection, 'chat_id', chat_id, chat_update(channel_name, user_id, bot_id))
+
+    async def add_group(self, user_id: int, group_name: str, group_id: int, bot_id: int = None):
+        """
+        Queue a group upsert
+
+        :param user_id: ID of user who added the group; None leaves the
+            recorded one unchanged
+        :param group_name: Name of the group
+        :param group_id: Telegram chat ID of the group
+        :param bot_id: ID of the bot added to the group
+        """
+        self._submit(self.db.groups_collection, 'chat_id', group_id, chat_update(group_name, user_id, bot_id))
+
+    async def add_membership(self, user_id: int, chat_id: int):
+        """
+        Queue recording that a user joined a channel or group
+
+        :param user_id: Telegram user ID
+        :param chat_id: Telegram chat ID of the channel or group
+        """
+        self._submit(self.db.memberships_collection, ('user_id', 'chat_id'), (user_id, chat_id), membership_update())
+
+    def record_join(self, chat_id: int, chat_title: str):
+        """
+        Count an approved join in the daily and per-chat rollups
+
+        :param chat_id: Telegram chat ID of the channel or group
+        :param chat_title: Title of the chat
+        """
+        now = datetime.now()
+        self._submit(self.db.daily_stats_collection, 'day', now.strftime('%Y-%m-%d'), {'$inc': {'joins': 1}})
+        self._submit(self.db.chat_stats_collection, 'chat_id', chat_id, {
+            '$inc': {'joins': 1},
+            '$set': {'name': chat_title, 'last_join': now}
+        })
+
+    async def flush(self):
+        """
+        Write everything pending as one unordered bulk_write per collection
+        """
+        async with self._flush_lock:
+            batches = []
+            for (collection, key_field, upsert), pending in self._pending.items():
+                if pending:
+                    batches.append((collection, key_field, upsert, dict(pending)))
+                    pending.clear()
+            self._pending_count = 0
+
+            for collection, key_field, upsert, updates in batches:
+                try:
+                    result = await self.db.bulk_upsert(collection, key_field, updates, upsert=upsert)
+                    self.written += len(updates)
+                    if collection is self.db.users_collection and upsert and result.upserted_count:
+                        # Users inserted by this flush are new users; counted in the next one
+                        self._submit(self.db.daily_stats_collection, 'day', datetime.now().strftime('%Y-%m-%d'),
+                                     {'$inc': {'new_users': result.upserted_count}})
+                except BulkWriteError as e:
+                    # Per-document errors (e.g. validation) will not succeed on retry
+                    errors = e.details.get('writeErrors', [])
+                    self.written += len(updates) - len(errors)
+                    self.failed += len(errors)
+                    logger.error(f"Bulk upsert into {collection.name} had {len(errors)} write errors")
+                except PyMongoError as e:
+                    # Transient failure: put the batch back under any newer writes
+                    logger.error(f"Bulk upsert into {collection.name} failed, will retry: {e}")
+                    self._requeue(collection, key_field, upsert, updates)
+                else:
+                    logger.debug(f"Flushed {len(updates)} upserts into {collection.name}")
+            if batches:
+                self.flushes += 1
+
+    def _requeue(self, collection, key_field: str, upsert: bool, updates: dict):
+        for key, update in updates.items():
+            pending = self._slot(collection, key_field, key, upsert)
+            if key in pending:
+                pending[key] = merge_update(update, pending[key])
+            else:
+                pending[key] = update
+                self._pending_count += 1
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Unexpected error flushing write-behind buffer: {e}")
+
+    def start(self):
+        """
+        Start the background flush task
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Stop the background task and flush whatever is still pending
+        """
+        # Let an in-flight flush finish rather than cancelling it mid-write
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        logger.info(f"Write-behind buffer closed: {self.stats()}")